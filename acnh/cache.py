@@ -0,0 +1,90 @@
+# © 2020 io mintz <io@mintz.cc>
+
+import collections
+import contextlib
+import hashlib
+import os
+import tempfile
+import threading
+
+import msgpack
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+class Cache:
+	"""A thread safe LRU cache of msgpack serializable values, bounded by the total size of the serialized values.
+
+	If directory is passed, entries are also written there, so that they survive restarts.
+	The on-disk tier is not bounded, so only use it for things that are cheap to store.
+	"""
+	def __init__(self, max_size=DEFAULT_MAX_SIZE, *, directory=None):
+		self.max_size = max_size
+		self.directory = directory
+		self.size = 0
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+		if directory is not None:
+			os.makedirs(directory, exist_ok=True)
+
+	@classmethod
+	def from_config(cls, config):
+		return cls(config.get('max-size', DEFAULT_MAX_SIZE), directory=config.get('directory'))
+
+	def get(self, key, default=None):
+		with self._lock:
+			packed = self._entries.get(key)
+			if packed is not None:
+				self._entries.move_to_end(key)
+
+		if packed is None:
+			packed = self._read(key)
+			if packed is None:
+				return default
+			self._remember(key, packed)
+
+		return msgpack.loads(packed)
+
+	def set(self, key, value):
+		packed = msgpack.dumps(value)
+		self._remember(key, packed)
+		self._write(key, packed)
+
+	def _remember(self, key, packed):
+		if len(packed) > self.max_size:
+			return
+
+		with self._lock:
+			old = self._entries.pop(key, None)
+			if old is not None:
+				self.size -= len(old)
+
+			self._entries[key] = packed
+			self.size += len(packed)
+
+			while self.size > self.max_size:
+				_, evicted = self._entries.popitem(last=False)
+				self.size -= len(evicted)
+
+	def _path(self, key):
+		# content addressed so that keys don't have to be valid file names
+		return os.path.join(self.directory, hashlib.sha256(repr(key).encode()).hexdigest())
+
+	def _read(self, key):
+		if self.directory is None:
+			return None
+
+		with contextlib.suppress(FileNotFoundError):
+			with open(self._path(key), 'rb') as f:
+				return f.read()
+
+		return None
+
+	def _write(self, key, packed):
+		if self.directory is None:
+			return
+
+		fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+		with os.fdopen(fd, 'wb') as f:
+			f.write(packed)
+		# atomic so that readers never see a partially written entry
+		os.replace(tmp_path, self._path(key))
@@ -23,12 +23,21 @@
 
 import contextlib
 import functools
+import os
+import queue
+import threading
+import time
+import traceback
 import urllib.parse
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from typing import List
 
 import msgpack
 import toml
 import requests
-from flask import g, request
+import requests.adapters
+from flask import current_app, g, request
 
 from nintendo.baas import BAASClient
 from nintendo.dauth import DAuthClient
@@ -39,11 +48,12 @@ from nintendo.nex.authentication import AuthenticationInfo
 from nintendo.games import ACNH
 from nintendo.settings import Settings
 
-from .utils import load_cached
+from .utils import REFRESH_MARGIN, load_cached, cached_age, invalidate_cached
 
 def init_app(app):
 	app.teardown_appcontext(close_clients)
-	app.after_request(close_backend)
+	app.teardown_request(close_backend)
+	app.before_request(start_token_refresher)
 
 # this is here to resolve circular imports
 # pylint: disable=wrong-import-position
@@ -64,6 +74,31 @@ with open(config['ticket-path'], 'rb') as f:
 
 backend_settings = Settings('switch.cfg')
 
+@dataclass(frozen=True)
+class CreatorAccount:
+	"""An in-game account that designs are uploaded to. Each has its own design slots."""
+	user_id: int
+	password: str = field(repr=False)
+	# the "creator ID" from the Designs Kiosk
+	creator_id: int
+
+	@property
+	def token_path(self):
+		return f'tokens/acnh-token-{self.creator_id}.msgpack'
+
+def load_creator_accounts() -> List[CreatorAccount]:
+	# if there's no list of accounts, the one account is configured at the top level
+	accounts = config.get('creator-accounts') or [config]
+	return [
+		CreatorAccount(account['acnh-user-id'], account['acnh-password'], account['acnh-design-creator-id'])
+		for account in accounts
+	]
+
+creator_accounts = load_creator_accounts()
+creator_accounts_by_id = {account.creator_id: account for account in creator_accounts}
+# used for everything that doesn't need to be done by a specific account
+default_account = creator_accounts[0]
+
 class ACNHClient:
 	BASE = 'https://api.hac.lp1.acbaa.srv.nintendo.net'
 	HEADERS = {
@@ -75,13 +110,27 @@ class ACNHClient:
 	# and ACNH doesn't use OPTIONS anyway
 	REQUEST_METHODS_WITH_BODIES = frozenset({'POST', 'PUT'})
 
-	def __init__(self, token):
-		self.token = token
+	def __init__(self, token, *, refresh_token=None):
+		"""If refresh_token is passed, it is called with the rejected token to get a new one
+		whenever the API responds with 401 Unauthorized, and the request is retried once.
+		"""
+		self.refresh_token = refresh_token
 		self.session = requests.Session()
+		# we only ever talk to one host, so one connection pool is enough
+		self.session.mount(self.BASE, requests.adapters.HTTPAdapter(pool_connections=1))
 		self.session.headers.clear()
 		self.session.headers.update(self.HEADERS)
-		self.session.headers['Authorization'] = 'Bearer ' + token
 		self.session.verify = 'data/nintendo-ca.crt'
+		self.token = token
+
+	@property
+	def token(self):
+		return self._token
+
+	@token.setter
+	def token(self, token):
+		self._token = token
+		self.session.headers['Authorization'] = 'Bearer ' + token
 
 	def request(self, method, path, **kwargs):
 		headers = {}
@@ -92,7 +141,12 @@ class ACNHClient:
 		if not path.startswith(self.BASE):
 			path = self.BASE + path
 
-		return self.session.request(method, path, headers=headers, **kwargs)
+		resp = self.session.request(method, path, headers=headers, **kwargs)
+		if resp.status_code == HTTPStatus.UNAUTHORIZED and self.refresh_token is not None:
+			self.token = self.refresh_token(self.token)
+			resp = self.session.request(method, path, headers=headers, **kwargs)
+
+		return resp
 
 	def __enter__(self):
 		return self.session.__enter__()
@@ -103,6 +157,57 @@ class ACNHClient:
 	def close(self):
 		self.session.close()
 
+class PooledACNHClient(ACNHClient):
+	"""An ACNHClient whose close() method returns it to the pool it came from."""
+	def __init__(self, pool, token, **kwargs):
+		super().__init__(token, **kwargs)
+		self.pool = pool
+
+	def close(self):
+		self.pool.release(self)
+
+class ACNHClientPool:
+	"""A thread safe pool of ACNH clients, so that requests can reuse warm keep-alive connections.
+
+	At most size idle clients are kept around. If none are idle, a new client is made,
+	so that checking out a client never blocks.
+	"""
+	def __init__(self, account, size):
+		self.account = account
+		self.size = size
+		self._idle = queue.LifoQueue(maxsize=size)
+
+	def acquire(self) -> PooledACNHClient:
+		token = acnh_token(self.account)
+		try:
+			client = self._idle.get_nowait()
+		except queue.Empty:
+			return PooledACNHClient(self, token, refresh_token=functools.partial(refresh_acnh_token, self.account))
+
+		# the token may have been rotated while this client was idle
+		if client.token != token:
+			client.token = token
+		return client
+
+	def release(self, client):
+		try:
+			self._idle.put_nowait(client)
+		except queue.Full:
+			ACNHClient.close(client)
+
+	def close(self):
+		while True:
+			try:
+				client = self._idle.get_nowait()
+			except queue.Empty:
+				return
+			ACNHClient.close(client)
+
+acnh_client_pools = {
+	account: ACNHClientPool(account, config.get('acnh-client-pool-size', 8))
+	for account in creator_accounts
+}
+
 gfuncs = []
 
 def close_clients(_):
@@ -110,6 +215,10 @@ def close_clients(_):
 		with contextlib.suppress(AttributeError):
 			getattr(g, f.__name__).close()
 
+	with contextlib.suppress(AttributeError):
+		for client in g.acnh_clients.values():
+			client.close()
+
 def gfunc(func):
 	@functools.wraps(func)
 	def wrapped():
@@ -143,72 +252,227 @@ def baas():
 	baas.authenticate(device_token())
 	return baas
 
-@gfunc
-def acnh():
-	_, id_token = baas_credentials()
-	acnh = ACNHClient(id_token)
-	acnh_token_ = acnh_token(acnh)
+def acnh(account: CreatorAccount = default_account) -> PooledACNHClient:
+	"""Return an ACNH client logged in as account, which is kept for the rest of the app context."""
 	try:
-		return ACNHClient(acnh_token_)
-	finally:
-		acnh.close()
-
-def backend():
-	with contextlib.suppress(AttributeError):
-		return request.backend
+		clients = g.acnh_clients
+	except AttributeError:
+		clients = g.acnh_clients = {}
 
-	backend = BackEndClient(backend_settings)
-	backend.configure(ACNH.ACCESS_KEY, ACNH.NEX_VERSION, ACNH.CLIENT_VERSION)
+	try:
+		return clients[account]
+	except KeyError:
+		client = clients[account] = acnh_client_pools[account].acquire()
+		return client
+
+class BackEndPool:
+	"""A thread safe pool of logged in game server sessions, since connecting and logging in takes several round trips.
+
+	The PRUDP transport pings the server on its own while a session is connected,
+	so idle sessions stay alive. Sessions older than max_age seconds are logged out and replaced,
+	and sessions that failed are discarded instead of being returned to the pool.
+	"""
+	def __init__(self, size, *, max_age):
+		self.size = size
+		self.max_age = max_age
+		self._idle = queue.LifoQueue(maxsize=size)
+		self._logged_in_at = {}
+
+	def acquire(self) -> BackEndClient:
+		while True:
+			try:
+				backend = self._idle.get_nowait()
+			except queue.Empty:
+				return self._login()
+
+			if time.monotonic() - self._logged_in_at[backend] < self.max_age:
+				return backend
+			self.discard(backend)
+
+	def release(self, backend):
+		try:
+			self._idle.put_nowait(backend)
+		except queue.Full:
+			self.discard(backend)
 
-	# connect to game server
-	backend.connect(HOST, PORT)
+	def discard(self, backend):
+		self._logged_in_at.pop(backend, None)
+		with contextlib.suppress(Exception):
+			backend.close()
 
-	# log in on game server
-	user_id, id_token = baas_credentials()
-	auth_info = AuthenticationInfo()
-	auth_info.token = id_token
-	auth_info.ngs_version = 4  # Switch
-	auth_info.token_type = 2
-	backend.login(str(user_id), auth_info=auth_info)
+	def _login(self):
+		backend = BackEndClient(backend_settings)
+		backend.configure(ACNH.ACCESS_KEY, ACNH.NEX_VERSION, ACNH.CLIENT_VERSION)
 
-	request.backend = backend
-	return backend
+		try:
+			# connect to game server
+			backend.connect(HOST, PORT)
+
+			# log in on game server
+			user_id, id_token = baas_credentials()
+			auth_info = AuthenticationInfo()
+			auth_info.token = id_token
+			auth_info.ngs_version = 4  # Switch
+			auth_info.token_type = 2
+			backend.login(str(user_id), auth_info=auth_info)
+		except BaseException:
+			# otherwise its socket and ping thread would leak
+			with contextlib.suppress(Exception):
+				backend.close()
+			raise
+
+		self._logged_in_at[backend] = time.monotonic()
+		return backend
+
+backend_pool = BackEndPool(config.get('backend-pool-size', 4), max_age=config.get('backend-session-max-age', 30 * 60))
 
-def close_backend(response):
+def backend():
 	with contextlib.suppress(AttributeError):
-		request.backend.close()
-	return response
+		return request.backend
 
-def device_token():
-	return load_cached('tokens/dauth-token.txt', lambda: dauth().device_token()['device_auth_token'])
+	request.backend = backend_pool.acquire()
+	return request.backend
 
-def aauth_token():
-	return load_cached('tokens/aauth-token.txt', lambda: aauth().auth_digital(
+def discard_backend():
+	"""Throw away this request's game server session, e.g. because it stopped working."""
+	with contextlib.suppress(AttributeError):
+		backend_pool.discard(request.backend)
+		del request.backend
+
+def close_backend(exc):
+	with contextlib.suppress(AttributeError):
+		if exc is None:
+			backend_pool.release(request.backend)
+		else:
+			backend_pool.discard(request.backend)
+
+DEVICE_TOKEN_PATH = 'tokens/dauth-token.txt'
+DEVICE_TOKEN_DURATION = 23 * 60 * 60
+AAUTH_TOKEN_PATH = 'tokens/aauth-token.txt'
+AAUTH_TOKEN_DURATION = 23 * 60 * 60
+BAAS_CREDENTIALS_PATH = 'tokens/baas-credentials.txt'
+BAAS_CREDENTIALS_DURATION = 2.5 * 60 * 60
+ACNH_TOKEN_DURATION = 5 * 60 * 60
+
+def device_token(*, refresh_margin=REFRESH_MARGIN):
+	return load_cached(
+		DEVICE_TOKEN_PATH,
+		lambda: dauth().device_token()['device_auth_token'],
+		duration=DEVICE_TOKEN_DURATION,
+		refresh_margin=refresh_margin,
+	)
+
+def aauth_token(*, refresh_margin=REFRESH_MARGIN):
+	return load_cached(AAUTH_TOKEN_PATH, lambda: aauth().auth_digital(
 		ACNH.TITLE_ID, ACNH.TITLE_VERSION,
 		device_token(), ticket
-	)['application_auth_token'])
+	)['application_auth_token'], duration=AAUTH_TOKEN_DURATION, refresh_margin=refresh_margin)
 
-def baas_credentials():
+def baas_credentials(*, refresh_margin=REFRESH_MARGIN):
 	def get_credentials():
 		resp = baas().login(config['baas-user-id'], config['baas-password'], aauth_token())
 		return toml.dumps({'user-id': int(resp['user']['id'], base=16), 'id-token': resp['idToken']})
 
-	resp = toml.loads(load_cached('tokens/baas-credentials.txt', get_credentials, duration=2.5 * 60 * 60))
+	resp = toml.loads(load_cached(
+		BAAS_CREDENTIALS_PATH,
+		get_credentials,
+		duration=BAAS_CREDENTIALS_DURATION,
+		refresh_margin=refresh_margin,
+	))
 	return resp['user-id'], resp['id-token']
 
-def acnh_token(acnh):
+_acnh_token_locks = {account: threading.Lock() for account in creator_accounts}
+
+def acnh_token(account: CreatorAccount, *, refresh_margin=REFRESH_MARGIN):
 	def get_acnh_token():
-		resp = acnh.request('POST', '/api/v1/auth_token', data=msgpack.dumps({
-			'id': config['acnh-user-id'],
-			'password': config['acnh-password'],
-		}))
+		_, id_token = baas_credentials()
+		acnh = ACNHClient(id_token)
+		try:
+			resp = acnh.request('POST', '/api/v1/auth_token', data=msgpack.dumps({
+				'id': account.user_id,
+				'password': account.password,
+			}))
+		finally:
+			acnh.close()
 		resp.raise_for_status()
 		return resp.content
 
 	resp = msgpack.loads(load_cached(
-		'tokens/acnh-token.msgpack',
+		account.token_path,
 		get_acnh_token,
-		duration=5 * 60 * 60,
+		duration=ACNH_TOKEN_DURATION,
 		binary=True,
+		refresh_margin=refresh_margin,
 	))
 	return resp['token']
+
+def refresh_acnh_token(account: CreatorAccount, rejected_token):
+	"""Get a new ACNH token for account after the API rejected rejected_token."""
+	with _acnh_token_locks[account]:
+		token = acnh_token(account)
+		# another thread already rotated it while we were waiting for the lock
+		if token != rejected_token:
+			return token
+
+		invalidate_cached(account.token_path)
+		return acnh_token(account)
+
+def token_ages():
+	"""Return how many seconds ago each token was refreshed, or None for tokens that have never been fetched."""
+	ages = {
+		'dauth': cached_age(DEVICE_TOKEN_PATH),
+		'aauth': cached_age(AAUTH_TOKEN_PATH),
+		'baas': cached_age(BAAS_CREDENTIALS_PATH),
+	}
+	for account in creator_accounts:
+		ages[f'acnh-{account.creator_id}'] = cached_age(account.token_path)
+	return ages
+
+class TokenRefresher:
+	"""A daemon thread that refreshes tokens before they expire, so that requests never have to log in.
+
+	It refreshes tokens when they are within margin seconds of expiring, which is more than the margin
+	that requests use, so that it always gets to them first.
+	Every process runs one, but only one process refreshes each token since load_cached locks it.
+	"""
+	def __init__(self, *, interval=60, margin=3 * REFRESH_MARGIN):
+		self.interval = interval
+		self.margin = margin
+		self._thread = None
+		self._pid = None
+		self._lock = threading.Lock()
+
+	def ensure_started(self, app):
+		# threads don't survive a fork, so the pre-forked web workers each need to start their own
+		if self._pid == os.getpid():
+			return
+
+		with self._lock:
+			if self._pid == os.getpid():
+				return
+			self._thread = threading.Thread(target=self._run, args=(app,), name='token-refresher', daemon=True)
+			self._thread.start()
+			self._pid = os.getpid()
+
+	def _run(self, app):
+		while True:
+			try:
+				# gfuncs such as baas() need an app context
+				with app.app_context():
+					self.refresh()
+			except Exception:  # pylint: disable=broad-except
+				traceback.print_exc()
+			time.sleep(self.interval)
+
+	def refresh(self):
+		# in dependency order, so that each login only waits for the ones it needs which are actually expiring
+		device_token(refresh_margin=self.margin)
+		aauth_token(refresh_margin=self.margin)
+		baas_credentials(refresh_margin=self.margin)
+		for account in creator_accounts:
+			acnh_token(account, refresh_margin=self.margin)
+
+token_refresher = TokenRefresher()
+
+def start_token_refresher():
+	token_refresher.ensure_started(current_app._get_current_object())
@@ -1,22 +1,27 @@
 # © 2020 io mintz <io@mintz.cc>
 
 import contextlib
-import operator
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from http import HTTPStatus
 from functools import wraps
-from typing import Union
+from typing import Dict, List, Optional, Union
 
 import msgpack
+import requests
+from flask import current_app
 
 from utils import config
 from .. import utils
-from ..common import acnh
+from ..cache import Cache
+from ..common import CreatorAccount, acnh
 from ..errors import (
 	UnknownDesignCodeError,
 	InvalidDesignCodeError,
 	InvalidDesignError,
 	DesignLitTheServerOnFireError,
+	DesignTimeoutError,
 )
 
 DesignId = Union[str, int]
@@ -25,6 +30,15 @@ MAX_DESIGNS = 120
 DESIGN_CODE_ALPHABET = InvalidDesignCodeError.DESIGN_CODE_ALPHABET
 DESIGN_CODE_ALPHABET_VALUES = InvalidDesignCodeError.DESIGN_CODE_ALPHABET_VALUES
 
+# designs cannot be updated, so their bodies can be cached forever.
+# unknown design IDs are only cached briefly since they might be used by a new design later.
+design_cache = Cache.from_config(config.get('design-cache', {}))
+UNKNOWN_DESIGN_CACHE_DURATION = 5 * 60
+
+# when a design code gets shared, lots of people request it at once. only download it once.
+DOWNLOAD_TIMEOUT = 30
+design_downloads = utils.SingleFlight(timeout=DOWNLOAD_TIMEOUT, timeout_error=DesignTimeoutError)
+
 def design_id(design_code):
 	code = design_code.replace('-', '')
 	n = 0
@@ -64,6 +78,56 @@ def accepts_design_id(func):
 
 @accepts_design_id
 def download_design(design_id, partial=False):
+	listed_headers = None
+	cached = design_cache.get(design_id)
+	if cached is not None:
+		if 'data' in cached:
+			return cached['headers'] if partial else cached['data']
+		if 'headers' in cached:
+			# only the headers are known, from a design listing
+			if partial:
+				return cached['headers']
+			listed_headers = cached['headers']
+		elif time.time() - cached['unknown_at'] < UNKNOWN_DESIGN_CACHE_DURATION:
+			raise UnknownDesignCodeError
+
+	return design_downloads.do((design_id, partial), _download_design, design_id, partial, listed_headers)
+
+def _download_design(design_id, partial, listed_headers=None):
+	headers = listed_headers
+	if headers is None:
+		headers = _download_design_headers(design_id)
+	if partial:
+		return headers
+
+	try:
+		data = _download_design_body(headers)
+	except requests.HTTPError:
+		if listed_headers is None:
+			raise
+		# the body URL from the listing may have expired since
+		headers = _download_design_headers(design_id)
+		data = _download_design_body(headers)
+
+	design_cache.set(design_id, {'headers': headers, 'data': data})
+	return data
+
+def _download_design_headers(design_id):
+	try:
+		return download_design_headers(design_id)
+	except UnknownDesignCodeError:
+		design_cache.set(design_id, {'unknown_at': time.time()})
+		raise
+
+def _download_design_body(headers):
+	url = urllib.parse.urlparse(headers['body'])
+	resp = acnh().request('GET', url.path + '?' + url.query)
+	resp.raise_for_status()
+	data = msgpack.loads(resp.content)
+	merge_headers(data, headers)
+	return data
+
+def download_design_headers(design_id):
 	resp = acnh().request('GET', '/api/v2/designs', params={
 		'offset': 0,
 		'limit': 1,
@@ -76,15 +140,7 @@ def download_design(design_id, partial=False):
 		raise UnknownDesignCodeError
 	if resp['total'] > 1:
 		raise RuntimeError('one ID requested, but more than one returned?!')
-	headers = resp['headers'][0]
-	if partial:
-		return headers
-
-	url = urllib.parse.urlparse(headers['body'])
-	resp = acnh().request('GET', url.path + '?' + url.query)
-	data = msgpack.loads(resp.content)
-	merge_headers(data, headers)
-	return data
+	return resp['headers'][0]
 
 def list_designs(author_id: int, *, pro: bool, with_binaries: bool = False):
 	resp = acnh().request('GET', '/api/v2/designs', params={
@@ -96,29 +152,51 @@ def list_designs(author_id: int, *, pro: bool, with_binaries: bool = False):
 	})
 	resp.raise_for_status()
 	resp = msgpack.loads(resp.content)
+	cache_listed_designs(resp['headers'])
 	return resp
 
-def stale_designs(needed, *, pro: bool):
-	r = list_designs(config['acnh-design-creator-id'], pro=pro)
-	free_slots = MAX_DESIGNS - r['count']
-	if free_slots >= needed:
-		return []
-	return sorted(r['headers'], key=operator.itemgetter('created_at'))[:needed]
+def cache_listed_designs(headers):
+	"""Remember the headers of listed designs, so that rendering their thumbnails afterwards only needs the body."""
+	for header in headers:
+		if 'body' in header and design_cache.get(header['id']) is None:
+			design_cache.set(header['id'], {'headers': header})
 
 @accepts_design_id
-def delete_design(design_id) -> None:
-	resp = acnh().request('DELETE', f'/api/v1/designs/{design_id}')
+def delete_design(design_id, account: CreatorAccount) -> None:
+	"""Delete a design. Designs can only be deleted by the account that created them."""
+	resp = acnh(account).request('DELETE', f'/api/v1/designs/{design_id}')
 	if resp.status_code == HTTPStatus.NOT_FOUND:
 		raise UnknownDesignCodeError
 
+# deleting designs one at a time makes users wait for lots of sequential round trips
+MAX_CONCURRENT_DELETIONS = 8
+_deletion_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DELETIONS)
+
+def delete_designs(design_ids: List[int], account: CreatorAccount) -> Dict[int, Optional[Exception]]:
+	"""Delete several designs created by account concurrently.
+	Returns a dict mapping each design ID to the exception raised while deleting it, or None if it was deleted.
+	"""
+	app = current_app._get_current_object()
+
+	def delete(design_id):
+		# each worker thread needs its own app context for acnh()
+		with app.app_context():
+			try:
+				delete_design(design_id, account)
+			except Exception as ex:  # pylint: disable=broad-except
+				return ex
+			return None
+
+	return dict(zip(design_ids, _deletion_executor.map(delete, design_ids)))
+
 design_errors = {
 	HTTPStatus.BAD_REQUEST: InvalidDesignError,
 	HTTPStatus.INTERNAL_SERVER_ERROR: DesignLitTheServerOnFireError,
 }
 
-def create_design(design_data) -> int:
-	"""create a design. returns the created design ID."""
-	resp = acnh().request('POST', '/api/v1/designs', data=msgpack.dumps(design_data))
+def create_design(design_data, account: CreatorAccount) -> int:
+	"""create a design on account. returns the created design ID."""
+	resp = acnh(account).request('POST', '/api/v1/designs', data=msgpack.dumps(design_data))
 	with contextlib.suppress(KeyError):
 		raise design_errors[resp.status_code]
 	resp.raise_for_status()
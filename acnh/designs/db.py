@@ -1,8 +1,13 @@
 # © 2020 io mintz <io@mintz.cc>
 
+import contextlib
+import datetime as dt
 import enum
+import json
+import operator
 import random
 import time
+from collections import defaultdict
 from dataclasses import dataclass, field
 from functools import partial
 from typing import List, Generic, TypeVar, Optional
@@ -12,8 +17,18 @@ from flask import request
 
 from . import api, encode
 from .format import SIZE, MAX_DESIGN_TILES
-from utils import pg, queries
-from ..errors import UnknownImageIdError, DeletionDeniedError, TiledImageTooBigError, ImageNameTooLongError, num_tiles
+from utils import pg, pg_connection, release_pg, queries
+from ..common import CreatorAccount, creator_accounts, creator_accounts_by_id
+from ..errors import (
+	ACNHError,
+	UnknownImageIdError,
+	UploadFailedError,
+	UploadTimeoutError,
+	DeletionDeniedError,
+	TiledImageTooBigError,
+	ImageNameTooLongError,
+	UnknownDesignCodeError,
+)
 
 ISLAND_NAMES = [
 	'The Cloud',
@@ -53,19 +68,132 @@ class PageSpecifier(Generic[T]):
 	def before(cls, reference: T) -> 'PageSpecifier[T]':
 		return cls(PageDirection.before, reference)
 
-def garbage_collect_designs(needed_slots: int, *, pro: bool):
-	"""Free at least needed_slots. Pass pro depending on whether Pro slots are needed."""
-	design_ids = [hdr['id'] for hdr in api.stale_designs(needed_slots, pro=pro)]
-	if not design_ids:
+# how often to check the local design slot ledger against the designs that are actually on Nintendo's servers
+SLOT_RECONCILIATION_INTERVAL = dt.timedelta(minutes=10)
+
+def garbage_collect_designs(needed_slots: int, account: CreatorAccount, *, pro: bool):
+	"""Free at least needed_slots on account. Pass pro depending on whether Pro slots are needed."""
+	maybe_reconcile_design_slots(account, pro=pro)
+
+	free_slots = api.MAX_DESIGNS - pg().fetchval(queries.used_design_slots(), account.creator_id, pro)
+	if free_slots >= needed_slots:
 		return
 
-	print('GC', len(design_ids), 'designs')
-	for design_id in design_ids:
-		api.delete_design(design_id)
+	to_free = needed_slots - free_slots
+	design_ids = pg().fetchvals(queries.delete_oldest_designs(), account.creator_id, pro, to_free)
+	untracked_ids = []
+	if len(design_ids) < to_free:
+		# the rest of the slots are used by designs that we don't know about
+		untracked_ids = oldest_untracked_designs(to_free - len(design_ids), account, pro=pro)
+
+	if not design_ids and not untracked_ids:
+		return
 
-	tag = pg().execute(queries.delete_designs(), design_ids)
-	if tag != f'DELETE {len(design_ids)}':
-		print('One or more stale design IDs were found in the API but not in the database! Ignoring…')
+	print('GC', len(design_ids) + len(untracked_ids), 'designs from', account.creator_id)
+	delete_designs(design_ids + untracked_ids, account, pro=pro)
+	if untracked_ids:
+		reconcile_design_slots(account, pro=pro)
+
+def oldest_untracked_designs(limit, account: CreatorAccount, *, pro: bool):
+	headers = api.list_designs(account.creator_id, pro=pro)['headers']
+	upstream_ids = [hdr['id'] for hdr in sorted(headers, key=operator.itemgetter('created_at'))]
+	return pg().fetchvals(queries.untracked_designs(), upstream_ids)[:limit]
+
+def choose_account(rows, *, pro: bool) -> CreatorAccount:
+	"""Pick which account to upload an image's designs to.
+	rows are the image's existing designs, which are kept together on the same account if possible.
+	Otherwise the least recently used account is chosen, so that uploads are spread across all of them.
+	"""
+	for row in rows:
+		with contextlib.suppress(KeyError):
+			return creator_accounts_by_id[row['creator_id']]
+
+	last_used = dict(pg().fetch(
+		queries.account_last_used(),
+		[account.creator_id for account in creator_accounts],
+		pro,
+	))
+	# accounts that have never been used sort first
+	return min(creator_accounts, key=lambda account: (
+		account.creator_id in last_used,
+		last_used.get(account.creator_id, 0),
+	))
+
+# deletions that fail this many times are given up on. reconciliation will find them eventually.
+MAX_DELETION_ATTEMPTS = 5
+REAP_BATCH_SIZE = 16
+
+def delete_designs(design_ids, account: CreatorAccount, *, pro: bool, deferred=False):
+	"""Delete designs created by account from Nintendo's servers concurrently.
+	If deferred, queue them for the reaper in upload_worker.py instead, and return immediately.
+	Designs which could not be deleted are queued for the reaper as well.
+	Returns a dict mapping each design ID to the exception raised while deleting it, or None if it was deleted.
+	"""
+	if deferred:
+		pg().execute(queries.queue_design_deletions(), design_ids, account.creator_id, pro, 0)
+		return {}
+
+	results = api.delete_designs(design_ids, account)
+	failed = [design_id for design_id, ex in results.items() if _deletion_failed(design_id, ex)]
+	if failed:
+		pg().execute(queries.queue_design_deletions(), failed, account.creator_id, pro, 1)
+	return results
+
+def _deletion_failed(design_id, ex):
+	# UnknownDesignCodeError means someone else already deleted it
+	if ex is None or isinstance(ex, UnknownDesignCodeError):
+		return False
+	print(f'Failed to delete design {design_id}:', repr(ex))
+	return True
+
+def reap_design_deletions() -> int:
+	"""Delete a batch of designs queued for deletion. Returns how many were processed."""
+	rows = pg().fetch(queries.claim_design_deletions(), REAP_BATCH_SIZE)
+	if not rows:
+		return 0
+
+	by_account = defaultdict(list)
+	for row in rows:
+		by_account[row['creator_id']].append(row)
+
+	for creator_id, account_rows in by_account.items():
+		try:
+			account = creator_accounts_by_id[creator_id]
+		except KeyError:
+			print('Dropping', len(account_rows), 'deletions for unconfigured creator account', creator_id)
+			continue
+
+		results = api.delete_designs([row['design_id'] for row in account_rows], account)
+		for row in account_rows:
+			if not _deletion_failed(row['design_id'], results[row['design_id']]):
+				continue
+			attempts = row['attempts'] + 1
+			if attempts < MAX_DELETION_ATTEMPTS:
+				pg().execute(queries.queue_design_deletions(), [row['design_id']], creator_id, row['pro'], attempts)
+
+	return len(rows)
+
+def maybe_reconcile_design_slots(account: CreatorAccount, *, pro: bool):
+	reconciled_at = pg().fetchval(queries.design_slots_reconciled_at(), account.creator_id, pro)
+	if reconciled_at is None or dt.datetime.now(dt.timezone.utc) - reconciled_at > SLOT_RECONCILIATION_INTERVAL:
+		reconcile_design_slots(account, pro=pro)
+
+def reconcile_design_slots(account: CreatorAccount, *, pro: bool):
+	"""Make the design slot ledger match the account's designs on Nintendo's servers.
+
+	Designs which are no longer on the server are forgotten, and designs which are on the server
+	but that we don't know about (e.g. because they were uploaded in game) are counted as used slots.
+	"""
+	started_at = dt.datetime.now(dt.timezone.utc)
+	upstream_ids = [hdr['id'] for hdr in api.list_designs(account.creator_id, pro=pro)['headers']]
+
+	with pg().transaction():
+		# designs created while we were listing them might not be in the list yet
+		deleted = pg().fetchvals(queries.delete_missing_designs(), account.creator_id, pro, upstream_ids, started_at)
+		if deleted:
+			print('Forgot', len(deleted), 'designs which were deleted upstream')
+		untracked = pg().fetchval(queries.count_untracked_designs(), upstream_ids)
+		pg().execute(queries.reconcile_design_slots(), account.creator_id, pro, untracked)
 
 def delete_image(image_id):
 	image_author_id = pg().fetchval(queries.image_author_id(), image_id)
@@ -76,61 +204,64 @@ def delete_image(image_id):
 		raise DeletionDeniedError
 
 	with pg().transaction(isolation='serializable'):
-		design_ids = pg().fetchvals(queries.delete_image_designs(), image_id)
-		pg().execute(queries.delete_image(), image_id)
-
-	for design_id in design_ids:
-		api.delete_design(design_id)
-
-def create_image(design, **kwargs):
+		designs = pg().fetch(queries.delete_image_designs(), image_id)
+		pro = pg().fetchval(queries.delete_image(), image_id)
+		by_account = defaultdict(list)
+		for row in designs:
+			by_account[row['creator_id']].append(row['design_id'])
+		# so that the user doesn't have to wait for them to be deleted from Nintendo's servers.
+		# queue them by creator ID since the reaper deals with accounts that are no longer configured.
+		for creator_id, design_ids in by_account.items():
+			pg().execute(queries.queue_design_deletions(), design_ids, creator_id, pro, 0)
+
+def create_image(design, **kwargs) -> int:
+	"""Save an image and queue it to be uploaded by upload_worker.py. Returns the image ID."""
 	return (create_pro_design if design.pro else create_basic_design)(design, **kwargs)
 
 def create_pro_design(design):
-	"""Upload a pro design. Returns an iterable for consistency with create_basic_design."""
-	was_quantized, encoded = encode.encode(design)
-	garbage_collect_designs(1, pro=True)
-	image_id = pg().fetchval(
-		queries.create_image(),
-
-		request.user_id,
-		design.author_name,
-		design.design_name,
-		None,  # width
-		None,  # height
-		None,  # mode
-		design.type_code,
-		[bytearray(image.export_pixels()) for image in design.layer_images.values()],
-	)
-	design_id = api.create_design(encoded)
-	create_design(image_id=image_id, design_id=design_id, position=1, pro=True)
-	yield image_id
-	yield was_quantized, design_id
+	# encode it now so that invalid designs are rejected before they are queued
+	encode.encode(design)
+	with pg().transaction():
+		image_id = pg().fetchval(
+			queries.create_image(),
+
+			request.user_id,
+			design.author_name,
+			design.design_name,
+			None,  # width
+			None,  # height
+			None,  # mode
+			design.type_code,
+			[bytearray(image.export_pixels()) for image in design.layer_images.values()],
+		)
+		pg().execute(queries.enqueue_upload(), image_id)
+	return image_id
 
 def create_basic_design(design, *, scale: bool):
-	"""Upload a basic design. Scale controls whether to tile or scale the image. Returns an iterable of design IDs."""
+	"""Scale controls whether to tile or scale the image."""
 	image = design.layer_images['0']
-	images = split_images(design, scale=scale)
+	# validate the tiling now, before it's queued
+	split_images(design, scale=scale)
 
 	# XXX is it a Design class or an Image class. It's both! Is that OK?
-	image_id = pg().fetchval(
-		queries.create_image(),
-
-		request.user_id,
-		design.author_name,
-		design.design_name,
-		image.width,
-		image.height,
-		'scale' if scale else 'tile',
-		design.type_code,
-		[bytearray(image.export_pixels())],
-	)
-	yield image_id
-	# backwards so that the first image shows up first in game
-	images = list(zip(reversed(range(1, len(images) + 1)), reversed(images)))
-	yield from create_designs(image_id, design, images, tile=not scale)
+	with pg().transaction():
+		image_id = pg().fetchval(
+			queries.create_image(),
+
+			request.user_id,
+			design.author_name,
+			design.design_name,
+			image.width,
+			image.height,
+			'scale' if scale else 'tile',
+			design.type_code,
+			[bytearray(image.export_pixels())],
+		)
+		pg().execute(queries.enqueue_upload(), image_id)
+	return image_id
 
-def create_designs(image_id, design, images, *, tile: bool):
-	garbage_collect_designs(len(images), pro=False)
+def create_designs(image_id, design, images, account: CreatorAccount, *, tile: bool):
+	garbage_collect_designs(len(images), account, pro=False)
 	for count, (i, image) in enumerate(images, 1):
 		design_name = f'{design.design_name} {i}' if tile else design.design_name
 		sub_design = encode.BasicDesign(
@@ -140,12 +271,19 @@ def create_designs(image_id, design, images, *, tile: bool):
 			layers={'0': image},
 		)
 		# we do this on each loop in case someone uploaded a few more designs in between iterations
-		garbage_collect_designs(len(images) - (count - 1), pro=False)
+		garbage_collect_designs(len(images) - (count - 1), account, pro=False)
 		# designs get out of order if we post them too fast
 		time.sleep(0.5)
 		was_quantized, encoded = encode.encode(sub_design)
-		design_id = api.create_design(encoded)
-		create_design(image_id=image_id, design_id=design_id, position=i, pro=False)
+		design_id = api.create_design(encoded, account)
+		create_design(
+			image_id=image_id,
+			design_id=design_id,
+			position=i,
+			pro=False,
+			was_quantized=was_quantized,
+			account=account,
+		)
 		yield was_quantized, design_id
 
 def split_images(design: encode.BasicDesign, *, scale: bool):
@@ -158,19 +296,100 @@ def split_images(design: encode.BasicDesign, *, scale: bool):
 	# scale if necessary
 	return [image.clone()]
 
-def refresh_image(image_id):
+def refresh_image(image_id, *, watch_existing=True):
+	"""Queue any deleted designs of an image to be recreated.
+	Returns an iterable of (was_quantized, design_id) for each recreated design, which finishes once they all are.
+	If the image was already queued by someone else and not watch_existing, returns None instead.
+	"""
 	rows = pg().fetch(queries.image_with_designs(), image_id)
 	if not rows:
 		raise UnknownImageIdError
-	image_info = rows[0]
-	required_design_count = 1 if image_info['pro'] else num_tiles(image_info['width'], image_info['height'])
-	if len(rows) == required_design_count:
+	if sum(row['design_id'] is not None for row in rows) == rows[0]['designs_required']:
+		return ()
+
+	queued = pg().fetchval(queries.enqueue_upload(), image_id) is not None
+	if not queued and not watch_existing:
 		return None
+	return upload_progress(image_id, skip_existing=True)
+
+UPLOAD_PROGRESS_POLL_INTERVAL = 0.5
+# give up watching after this long, in case no upload worker is running or the queue is backed up
+UPLOAD_PROGRESS_TIMEOUT = 5 * 60
+# if a worker has been uploading an image for this long, assume that it died
+STALE_UPLOAD_TIMEOUT = 10 * 60
+
+def upload_progress(image_id, *, skip_existing=False):
+	"""Return an iterable of (was_quantized, design_id) for each design of the image as it gets uploaded.
+	If the upload fails or takes longer than UPLOAD_PROGRESS_TIMEOUT, the last item is the error dict.
+	If skip_existing, designs which were already uploaded when this was called are skipped.
+	"""
+	if pg().fetchrow(queries.upload_job(), image_id) is None:
+		raise UnknownImageIdError
 
+	seen = set()
+	if skip_existing:
+		seen.update(row['design_id'] for row in pg().fetch(queries.image_designs(), image_id))
+
+	return _upload_progress(image_id, seen)
+
+def _upload_progress(image_id, seen):
+	# don't hold a connection for the whole stream, or a few people watching slow uploads would use up the pool
+	release_pg()
+	deadline = time.monotonic() + UPLOAD_PROGRESS_TIMEOUT
+	while True:
+		with pg_connection() as conn:
+			# check the status first so that we don't miss any designs uploaded right before it finished
+			job = conn.fetchrow(queries.upload_job(), image_id)
+			rows = conn.fetch(queries.image_designs(), image_id)
+
+		for row in rows:
+			if row['design_id'] not in seen:
+				seen.add(row['design_id'])
+				yield row['was_quantized'], row['design_id']
+
+		# images uploaded before the queue existed have no job
+		if job is None or job['status'] in (None, 'done'):
+			return
+		if job['status'] == 'failed':
+			yield json.loads(job['error'])
+			return
+		if time.monotonic() >= deadline:
+			yield UploadTimeoutError().to_dict()
+			return
+
+		time.sleep(UPLOAD_PROGRESS_POLL_INTERVAL)
+
+def claim_upload() -> Optional[int]:
+	"""Mark the oldest queued upload as running and return its image ID, or None if there isn't one."""
+	return pg().fetchval(queries.claim_upload(), STALE_UPLOAD_TIMEOUT)
+
+def process_upload(image_id):
+	"""Upload every design of the image that is missing, then mark its job as finished."""
+	try:
+		for _ in upload_missing_designs(image_id):
+			pass
+	except ACNHError as ex:
+		pg().execute(queries.finish_upload(), image_id, 'failed', json.dumps(ex.to_dict()))
+	except Exception:
+		pg().execute(queries.finish_upload(), image_id, 'failed', json.dumps(UploadFailedError().to_dict()))
+		raise
+	else:
+		pg().execute(queries.finish_upload(), image_id, 'done', None)
+
+def upload_missing_designs(image_id):
+	rows = pg().fetch(queries.image_with_designs(), image_id)
+	if not rows:
+		raise UnknownImageIdError
+	image_info = rows[0]
+	rows = [row for row in rows if row['design_id'] is not None]
+	if len(rows) == image_info['designs_required']:
+		return
+
+	account = choose_account(rows, pro=image_info['pro'])
 	if image_info['pro']:
-		yield from refresh_pro_image(image_info)
+		yield from upload_pro_image(image_info, account)
 	else:
-		yield from refresh_basic_image(rows)
+		yield from upload_basic_image(image_info, rows, account)
 
 def gather_layers(cls, layers: List[wand.image.Image]):
 	named_layers = {}
@@ -179,20 +398,40 @@ def gather_layers(cls, layers: List[wand.image.Image]):
 		img.import_pixels(data=blob, channel_map='RGBA')
 	return named_layers
 
-def refresh_pro_image(image_info):
+def image_design(image_info) -> encode.Design:
+	"""Load the stored layers of an image, as returned by image(), into a Design."""
+	cls = encode.Design(image_info['type_code'])
+	kwargs = dict(author_name=image_info['author_name'], design_name=image_info['image_name'])
+	if image_info['pro']:
+		# pylint: disable=not-callable
+		return cls(layers=gather_layers(cls, image_info['layers']), **kwargs)
+
+	img = wand.image.Image(width=image_info['width'], height=image_info['height'])
+	img.import_pixels(data=image_info['layers'][0], channel_map='RGBA')
+	# pylint: disable=not-callable
+	return cls(layers={'0': img}, **kwargs)
+
+def upload_pro_image(image_info, account: CreatorAccount):
 	cls = encode.Design(image_info['type_code'])
 	layers = gather_layers(cls, image_info['layers'])
 
 	# pylint: disable=not-callable
 	design = cls(layers=layers, island_name=island_name(), design_name=image_info['image_name'])
 	was_quantized, encoded = encode.encode(design)
-	design_id = api.create_design(encoded)
-	create_design(image_id=image_info['image_id'], design_id=design_id, position=0, pro=True)
+	garbage_collect_designs(1, account, pro=True)
+	design_id = api.create_design(encoded, account)
+	create_design(
+		image_id=image_info['image_id'],
+		design_id=design_id,
+		position=1,
+		pro=True,
+		was_quantized=was_quantized,
+		account=account,
+	)
 	yield was_quantized, design_id
 
-def refresh_basic_image(rows):
-	image_info = rows[0]
-	required_design_count = num_tiles(image_info['width'], image_info['height'])
+def upload_basic_image(image_info, rows, account: CreatorAccount):
+	required_design_count = image_info['designs_required']
 
 	design_positions = {row['position'] for row in rows}
 	required_positions = set(range(1, required_design_count + 1))
@@ -202,18 +441,25 @@ def refresh_basic_image(rows):
 	img.import_pixels(data=image_info['layers'][0], channel_map='RGBA')
 	design = encode.BasicDesign(layers={'0': img}, design_name=image_info['image_name'], island_name=island_name())
 	images = split_images(design, scale=image_info['mode'] == 'scale')
-	to_create = [(i, img) for i, img in enumerate(images, 1) if i in missing_positions]
-	yield from create_designs(image_info['image_id'], design, to_create, tile=image_info['mode'] == 'tile')
+	# backwards so that the first image shows up first in game
+	to_create = [(i, img) for i, img in reversed(list(enumerate(images, 1))) if i in missing_positions]
+	yield from create_designs(image_info['image_id'], design, to_create, account, tile=image_info['mode'] == 'tile')
 
-def create_design(*, image_id, design_id, position, pro):
-	pg().execute(queries.create_design(), image_id, design_id, position, pro)
+def create_design(*, image_id, design_id, position, pro, was_quantized, account: CreatorAccount):
+	pg().execute(queries.create_design(), image_id, design_id, position, pro, was_quantized, account.creator_id)
+
+def validate_image_exists(image_id):
+	"""Raise UnknownImageIdError if there is no such image, without fetching any of it."""
+	if not pg().fetchval(queries.image_exists(), image_id):
+		raise UnknownImageIdError
 
 def image(image_id):
 	rows = pg().fetch(queries.image_with_designs(), image_id)
 	if not rows:
 		raise UnknownImageIdError
 	image = dict(rows[0])
-	# these are design fields not image fields
+	# these are design fields not image fields.
+	# creator_id is kept since all of an image's designs are on the same account.
 	del image['design_id'], image['position']
 	designs = {}
 	for row in rows:
@@ -2,31 +2,39 @@
 
 import contextlib
 import datetime as dt
-import io
 import itertools
 import random
-import struct
 from dataclasses import dataclass, field
-from typing import List, Dict, Type, ClassVar, Tuple, Optional, DefaultDict
+from typing import List, Dict, Type, ClassVar, Tuple, Optional, DefaultDict, Sequence, Union
 
+import msgpack
+import numpy as np
 import wand.image
 import wand.color
-import msgpack
 
-from .. import utils
-from .format import PALETTE_SIZE, SIZE as STANDARD, WIDTH as STANDARD_WIDTH, HEIGHT as STANDARD_HEIGHT
+from .format import BYTES_PER_PIXEL, PALETTE_SIZE, SIZE as STANDARD, WIDTH as STANDARD_WIDTH, HEIGHT as STANDARD_HEIGHT
+from .pixels import (
+	TRANSPARENT_INDEX,
+	IndexedImage,
+	Pixels,
+	as_rgba,
+	LayerCorrespondence,
+	CompiledCorrespondence,
+	NetImagePlacement,
+	NetImagePlan,
+)
 from ..errors import InvalidLayerNameError, MissingLayerError, InvalidPaletteError, InvalidLayerSizeError
-from utils import config
 
-XY = Tuple[int, int]
+def rgba_to_wand(pixels: np.ndarray) -> wand.image.Image:
+	height, width, _ = pixels.shape
+	im = wand.image.Image(width=width, height=height)
+	im.import_pixels(channel_map='RGBA', data=np.ascontiguousarray(pixels).tobytes())
+	return im
 
-@dataclass
-class LayerCorrespondence:
-	internal_idx: int
-	external_name: str
-	internal_pos: XY
-	external_pos: XY
-	dimensions: XY
+def wand_to_rgba(image: wand.image.Image) -> np.ndarray:
+	"""Return the pixels of image as a (height, width, 4) array."""
+	pixels = np.frombuffer(bytearray(image.export_pixels(channel_map='RGBA')), dtype=np.uint8)
+	return pixels.reshape(image.height, image.width, BYTES_PER_PIXEL)
 
 class LayerMeta(type):
 	def __mul__(cls, x):
@@ -46,6 +54,10 @@ class Layer(metaclass=LayerMeta):
 		im.background_color = wand.color.Color('rgba(0,0,0,0)')
 		return im
 
+	def as_array(self) -> np.ndarray:
+		"""Return a transparent (height, width, 4) RGBA array the size of this layer."""
+		return np.zeros((self.height, self.width, BYTES_PER_PIXEL), dtype=np.uint8)
+
 	def validate(self, image):
 		if image.size != self.size:
 			raise InvalidLayerSizeError(self.name, *self.size)
@@ -58,8 +70,6 @@ class Layer(metaclass=LayerMeta):
 	def height(self):
 		return self.size[1]
 
-NET_IMAGE_BASE = Layer('', (240, 240)).as_wand()
-
 class Design:
 	# shared static vars
 	design_types: ClassVar[Dict[str, Type['Design']]] = {}
@@ -75,6 +85,11 @@ class Design:
 	# the layers that are sent to the API
 	internal_layers: ClassVar[List[Optional[Layer]]]
 	correspondence: ClassVar[Optional[List[LayerCorrespondence]]]
+	compiled_correspondence: ClassVar[Optional[List[CompiledCorrespondence]]]
+	# where each external layer goes on the net image, which is the thumbnail shown in game
+	net_image_layout: ClassVar[List[NetImagePlacement]]
+	net_image_background: ClassVar[Optional[Tuple[int, int, int, int]]] = None
+	net_image_plan: ClassVar[NetImagePlan]
 	category: ClassVar[str]
 
 	# instance vars
@@ -83,7 +98,6 @@ class Design:
 	island_name: Optional[str]
 	design_name: Optional[str]
 	created_at: Optional[dt.datetime]
-	layer_images: Dict[str, wand.image.Image]
 
 	def __init_subclass__(cls):
 		if (
@@ -111,8 +125,26 @@ class Design:
 		cls.one_to_one = cls.correspondence is None
 		cls.pro = len(cls.internal_layers) > 1
 
+		cls.compiled_correspondence = None
+		if not cls.one_to_one:
+			compiled = (
+				c.compile(cls.internal_layers[c.internal_idx], cls.external_layer_names[c.external_name])
+				for c in cls.correspondence
+			)
+			cls.compiled_correspondence = [c for c in compiled if c is not None]
+
+		net_image_mask = None
 		if cls.pro:
-			cls.net_image_mask = wand.image.Image(filename=f'data/net image masks/{cls.name}.png')
+			with wand.image.Image(filename=f'data/net image masks/{cls.name}.png') as mask:
+				net_image_mask = wand_to_rgba(mask)
+
+		cls.net_image_plan = NetImagePlan(
+			cls.net_image_layout,
+			background=cls.net_image_background,
+			mask=net_image_mask,
+		)
+		# compile it now for the usual layer sizes so that the first request doesn't have to
+		cls.net_image_plan.compile(tuple(cls.external_layer_names[name].size for name in cls.net_image_plan.layer_names))
 
 	def __new__(cls, type=None, **kwargs):
 		# this is really two constructors:
@@ -144,7 +176,10 @@ class Design:
 		self.island_name = island_name
 		self.design_name = design_name
 		self.created_at = created_at
-		self.layer_images = layers
+		self._layer_images = layers
+		self._layer_arrays = None
+		self._layer_indices = None
+		self._palette = None
 		return self
 
 	@classmethod
@@ -155,13 +190,13 @@ class Design:
 
 	@classmethod
 	def from_data(cls, data: dict):
-		from .render import render_layers  # resolve circular import
+		from .render import palette_table, unpack_indices  # resolve circular import
 
-		internal_layers = [layer for i, layer in render_layers(data['mData'])]
 		type_code = data['mMeta']['mMtUse']
 		subcls = cls(type_code)
-		return subcls.externalize(
-			internal_layers,
+		return subcls.externalize_indexed(
+			palette_table(data),
+			unpack_indices(list(data['mData'].values())),
 			author_id=data['author_id'],
 			author_name=data['author_name'],
 			island_name=data['mMeta']['mMtVNm'],
@@ -170,49 +205,89 @@ class Design:
 		)
 
 	def internalize(self) -> List[wand.image.Image]:
+		return list(map(rgba_to_wand, self.internalize_arrays()))
+
+	@property
+	def layer_images(self) -> Dict[str, wand.image.Image]:
+		if self._layer_images is None:
+			self._layer_images = {name: rgba_to_wand(pixels) for name, pixels in self.layer_arrays().items()}
+		return self._layer_images
+
+	def layer_arrays(self) -> Dict[str, np.ndarray]:
+		"""Return the RGBA pixels of each external layer of this design."""
+		if self._layer_arrays is None:
+			if self._layer_indices is not None:
+				self._layer_arrays = {name: self._palette[indices] for name, indices in self._layer_indices.items()}
+			else:
+				self._layer_arrays = {name: wand_to_rgba(image) for name, image in self.layer_images.items()}
+		return self._layer_arrays
+
+	def layer_pixels(self) -> Dict[str, Pixels]:
+		"""Return each external layer of this design as an IndexedImage if it came from the game, otherwise as RGBA."""
+		if self._layer_indices is not None:
+			return {name: IndexedImage(self._palette, indices) for name, indices in self._layer_indices.items()}
+		return self.layer_arrays()
+
+	def internalize_arrays(self) -> List[np.ndarray]:
+		"""Return the RGBA pixels of each internal layer of this design."""
+		external = self.layer_arrays()
 		if self.one_to_one:
-			return list(self.layer_images.values())
+			return list(external.values())
 
-		out = list(map(Layer.as_wand, self.internal_layers))
-		for c in self.correspondence:
-			dst = out[c.internal_idx]
-			dst_position = c.internal_pos
-			src = self.layer_images[c.external_name]
-			src_position = c.external_pos
-			self.copy(dst, src, dst_position, src_position, c.dimensions)
+		out = [layer.as_array() for layer in self.internal_layers]
+		for c in self.compiled_correspondence:
+			out[c.internal_idx][c.internal_slices] = external[c.external_name][c.external_slices]
 
 		return out
 
 	@classmethod
-	def externalize(cls, internal_layers: List[wand.image.Image], **kwargs) -> 'Design':
+	def externalize(cls, internal_layers: Sequence[Union[np.ndarray, wand.image.Image]], **kwargs) -> 'Design':
+		internal_layers = [
+			wand_to_rgba(layer) if isinstance(layer, wand.image.Image) else layer
+			for layer in internal_layers
+		]
+		# wand images are only made if something asks for them
+		self = cls(layers=None, **kwargs)
+		self._layer_arrays = cls.externalize_arrays(internal_layers)
+		return self
+
+	@classmethod
+	def externalize_indexed(cls, palette: np.ndarray, internal_indices: Sequence[np.ndarray], **kwargs) -> 'Design':
+		"""Like externalize, but for internal layers of indices into palette, which the external layers share."""
+		self = cls(layers=None, **kwargs)
+		self._palette = palette
+		self._layer_indices = cls.externalize_arrays(internal_indices, fill=TRANSPARENT_INDEX)
+		return self
+
+	@classmethod
+	def externalize_arrays(cls, internal_layers: Sequence[np.ndarray], *, fill=0) -> Dict[str, np.ndarray]:
+		"""Given the pixels of each internal layer, return the pixels of each external layer.
+		The pixels may be RGBA or palette indices. Anything not covered by an internal layer is set to fill.
+		"""
 		if cls.one_to_one:
-			return cls(
-				layers={cls.external_layers[i].name: img for i, img in enumerate(internal_layers)},
-				**kwargs,
-			)
+			return {layer.name: pixels for layer, pixels in zip(cls.external_layers, internal_layers)}
 
-		out = {layer.name: layer.as_wand() for layer in cls.external_layers}
-		for c in cls.correspondence:
-			dst = out[c.external_name]
-			dst_position = c.external_pos
-			src = internal_layers[c.internal_idx]
-			src_position = c.internal_pos
-			cls.copy(dst, src, dst_position, src_position, c.dimensions)
+		pixel_shape, dtype = internal_layers[0].shape[2:], internal_layers[0].dtype
+		out = {
+			layer.name: np.full((layer.height, layer.width, *pixel_shape), fill, dtype=dtype)
+			for layer in cls.external_layers
+		}
+		for c in cls.compiled_correspondence:
+			out[c.external_name][c.external_slices] = internal_layers[c.internal_idx][c.internal_slices]
 
-		return cls(layers=out, **kwargs)
+		return out
 
-	# pylint: disable=too-many-arguments
-	@classmethod
-	def copy(cls, dst, src, dst_position, src_position, dimensions):
-		width, height = dimensions
-		x, y = src_position
-		x_slice = slice(x, x + width)
-		y_slice = slice(y, y + height)
-		dst.composite(src[x_slice, y_slice], *dst_position)
-
-	# pylint: disable=no-self-use
 	def net_image(self) -> wand.image.Image:
-		...
+		return rgba_to_wand(self.net_image_array())
+
+	def net_image_array(self) -> np.ndarray:
+		return as_rgba(self.net_image_pixels())
+
+	def net_image_pixels(self) -> Pixels:
+		"""Draw the net image, keeping it indexed if possible."""
+		if self._layer_indices is not None:
+			return self.net_image_plan.draw_indexed(self._palette, self._layer_indices)
+		return self.net_image_plan.draw(self.layer_arrays())
 
 	def validate(self):
 		for layer in self.external_layer_names.values():
@@ -282,79 +357,63 @@ LONG_BODY_CORRESPONDENCE = [
 	LayerCorrespondence(3, 'back', (0, 0), (0, 32), (32, 9)),
 ]
 
+STANDARD_BODY_NET_IMAGE = [
+	NetImagePlacement('back', (6, 6), (112, 113)),
+	NetImagePlacement('front', (121, 6), (113, 113)),
+]
+
+LONG_BODY_NET_IMAGE = [
+	NetImagePlacement('back', (6, 6), (112, 145)),
+	NetImagePlacement('front', (121, 6), (113, 145)),
+]
+
+SHORT_SLEEVE_NET_IMAGE = [
+	NetImagePlacement('right-sleeve', (26, 157), (72, 44)),
+	NetImagePlacement('left-sleeve', (141, 157), (72, 44)),
+]
+
+LONG_SLEEVE_NET_IMAGE = [
+	NetImagePlacement('right-sleeve', (26, 157), (72, 77)),
+	NetImagePlacement('left-sleeve', (141, 157), (72, 77)),
+]
+
+WIDE_SLEEVE_NET_IMAGE = [
+	NetImagePlacement('right-sleeve', (10, 157), (105, 77)),
+	NetImagePlacement('left-sleeve', (125, 157), (105, 77)),
+]
+
 class BasicDesign(Design):
 	type_code = 99
 	display_name = 'Basic design'
 	external_layers = Layer * 1
+	net_image_layout = [NetImagePlacement('0', (5, 5), (230, 230))]
+	# the border
+	net_image_background = (0xf3, 0xf5, 0xe7, 0xff)
 
-	def net_image(self):
-		net_img = self.layer_images['0'].clone()
-		net_img.scale(230, 230)
-		net_img.border(wand.color.Color('#f3f5e7'), 5, 5)
-		return net_img
-
-class StandardBodyMixin:
-	def net_image(self):
-		net_img = NET_IMAGE_BASE.clone()
-		back = self.layer_images['back'].clone()
-		back.scale(112, 113)
-		net_img.composite(back, 6, 6)
-		front = self.layer_images['front'].clone()
-		front.scale(113, 113)
-		net_img.composite(front, 121, 6)
-		return net_img
-
-class TankTop(StandardBodyMixin, Design):
+class TankTop(Design):
 	type_code = 102
 	display_name = 'Tank top'
 	category = 'Tops'
 	external_layers = STANDARD_BODY_LAYERS
+	net_image_layout = STANDARD_BODY_NET_IMAGE
 
-	def net_image(self):
-		net_img = super().net_image()
-		net_img.composite(self.net_image_mask, 0, 0)
-		return net_img
-
-class ShortSleeveMixin:
-	def net_image(self):
-		net_img = super().net_image()
-		right_sleeve = self.layer_images['right-sleeve'].clone()
-		right_sleeve.scale(72, 44)
-		net_img.composite(right_sleeve, 26, 157)
-		left_sleeve = self.layer_images['left-sleeve'].clone()
-		left_sleeve.scale(72, 44)
-		net_img.composite(left_sleeve, 141, 157)
-		net_img.composite(self.net_image_mask, 0, 0)
-		return net_img
-
-# multiple inheritance as function composition 😎
-class ShortSleeveTee(ShortSleeveMixin, StandardBodyMixin, Design):
+class ShortSleeveTee(Design):
 	type_code = 101
 	display_name = 'Short-sleeve tee'
 	category = 'Tops'
 	external_layers = STANDARD_BODY_LAYERS + SHORT_SLEEVE_LAYERS
 	internal_layers = Layer * 4
 	correspondence = STANDARD_BODY_CORRESPONDENCE + SHORT_SLEEVE_CORRESPONDENCE
+	net_image_layout = STANDARD_BODY_NET_IMAGE + SHORT_SLEEVE_NET_IMAGE
 
-class LongSleeveMixin:
-	def net_image(self):
-		net_img = super().net_image()
-		right_sleeve = self.layer_images['right-sleeve'].clone()
-		right_sleeve.scale(72, 77)
-		net_img.composite(right_sleeve, 26, 157)
-		left_sleeve = self.layer_images['left-sleeve'].clone()
-		left_sleeve.scale(72, 77)
-		net_img.composite(left_sleeve, 141, 157)
-		net_img.composite(self.net_image_mask, 0, 0)
-		return net_img
-
-class LongSleeveDressShirt(LongSleeveMixin, StandardBodyMixin, Design):
+class LongSleeveDressShirt(Design):
 	type_code = 100
 	display_name = 'Long-sleeve dress shirt'
 	category = 'Tops'
 	external_layers = STANDARD_BODY_LAYERS + LONG_SLEEVE_LAYERS
 	internal_layers = Layer * 4
 	correspondence = STANDARD_BODY_CORRESPONDENCE + LONG_SLEEVE_CORRESPONDENCE
+	net_image_layout = STANDARD_BODY_NET_IMAGE + LONG_SLEEVE_NET_IMAGE
 
 class Sweater(LongSleeveDressShirt):
 	type_code = 103
@@ -363,43 +422,31 @@ class Sweater(LongSleeveDressShirt):
 class Hoodie(LongSleeveDressShirt):
 	type_code = 104
 
-class LongBodyMixin:
-	def net_image(self):
-		net_img = NET_IMAGE_BASE.clone()
-		back = self.layer_images['back'].clone()
-		back.scale(112, 145)
-		net_img.composite(back, 6, 6)
-		front = self.layer_images['front'].clone()
-		front.scale(113, 145)
-		net_img.composite(front, 121, 6)
-		return net_img
-
-class SleevelessDress(LongBodyMixin, Design):
+class SleevelessDress(Design):
 	type_code = 107
 	display_name = 'Sleeveless dress'
 	category = 'Dress-up'
 	external_layers = LONG_BODY_LAYERS
 	internal_layers = Layer * 4
 	correspondence = LONG_BODY_CORRESPONDENCE
+	net_image_layout = LONG_BODY_NET_IMAGE
 
-	def net_image(self):
-		net_img = super().net_image()
-		net_img.composite(self.net_image_mask, 0, 0)
-		return net_img
-
-class Coat(LongSleeveMixin, LongBodyMixin, Design):
+class Coat(Design):
 	type_code = 105
 	category = 'Tops'
 	external_layers = LONG_BODY_LAYERS + LONG_SLEEVE_LAYERS
+	internal_layers = Layer * 4
 	correspondence = LONG_BODY_CORRESPONDENCE + LONG_SLEEVE_CORRESPONDENCE
+	net_image_layout = LONG_BODY_NET_IMAGE + LONG_SLEEVE_NET_IMAGE
 
-class ShortSleeveDress(ShortSleeveMixin, LongBodyMixin, Design):
+class ShortSleeveDress(Design):
 	type_code = 106
 	display_name = 'Short-sleeve dress'
 	category = 'Dress-up'
 	external_layers = LONG_BODY_LAYERS + SHORT_SLEEVE_LAYERS
 	internal_layers = Layer * 4
 	correspondence = LONG_BODY_CORRESPONDENCE + SHORT_SLEEVE_CORRESPONDENCE
+	net_image_layout = LONG_BODY_NET_IMAGE + SHORT_SLEEVE_NET_IMAGE
 
 class LongSleeveDress(Coat):
 	type_code = 108
@@ -414,23 +461,13 @@ class BalloonHemDress(ShortSleeveDress):
 	type_code = 109
 	display_name = 'Balloon-hem dress'
 
-class Robe(LongBodyMixin, Design):
+class Robe(Design):
 	type_code = 111
 	category = 'Dress-up'
 	external_layers = LONG_BODY_LAYERS + WIDE_SLEEVE_LAYERS
 	internal_layers = Layer * 4
 	correspondence = LONG_BODY_CORRESPONDENCE + WIDE_SLEEVE_CORRESPONDENCE
-
-	def net_image(self):
-		net_img = super().net_image()
-		right_sleeve = self.layer_images['right-sleeve'].clone()
-		right_sleeve.scale(105, 77)
-		net_img.composite(right_sleeve, 10, 157)
-		left_sleeve = self.layer_images['left-sleeve'].clone()
-		left_sleeve.scale(105, 77)
-		net_img.composite(left_sleeve, 125, 157)
-		net_img.composite(self.net_image_mask, 0, 0)
-		return net_img
+	net_image_layout = LONG_BODY_NET_IMAGE + WIDE_SLEEVE_NET_IMAGE
 
 class BrimmedCap(Design):
 	type_code = 112
@@ -452,20 +489,11 @@ class BrimmedCap(Design):
 		LayerCorrespondence(2, 'brim', (0, 11), (0, 0), (32, 21)),
 		LayerCorrespondence(3, 'brim', (0, 11), (32, 0), (12, 21)),
 	]
-
-	def net_image(self) -> wand.image.Image:
-		net_img = NET_IMAGE_BASE.clone()
-		front = self.layer_images['front'].clone()
-		front.scale(151, 146)
-		net_img.composite(front, 8, 4)
-		brim = self.layer_images['brim'].clone()
-		brim.scale(150, 69)
-		net_img.composite(brim, 9, 163)
-		back = self.layer_images['back'].clone()
-		back.scale(66, 147)
-		net_img.composite(back, 166, 13)
-		net_img.composite(self.net_image_mask, 0, 0)
-		return net_img
+	net_image_layout = [
+		NetImagePlacement('front', (8, 4), (151, 146)),
+		NetImagePlacement('brim', (9, 163), (150, 69)),
+		NetImagePlacement('back', (166, 13), (66, 147)),
+	]
 
 class KnitCap(Design):
 	type_code = 113
@@ -485,14 +513,7 @@ class KnitCap(Design):
 		LayerCorrespondence(0, 'cap', (0, 0), (0, 32), STANDARD),
 		LayerCorrespondence(0, 'cap', (0, 0), (32, 32), STANDARD),
 	]
-
-	def net_image(self):
-		net_img = NET_IMAGE_BASE.clone()
-		cap = self.layer_images['cap'].clone()
-		cap.scale(228, 182)
-		net_img.composite(cap, 6, 10)
-		net_img.composite(self.net_image_mask, 0, 0)
-		return net_img
+	net_image_layout = [NetImagePlacement('cap', (6, 10), (228, 182))]
 
 class BrimmedHat(Design):
 	type_code = 114
@@ -514,27 +535,15 @@ class BrimmedHat(Design):
 		LayerCorrespondence(2, 'bottom', (0, 23), (0, 0), (32, 9)),
 		LayerCorrespondence(3, 'bottom', (0, 23), (32, 0), (32, 9)),
 	]
-
-	def net_image(self) -> wand.image.Image:
-		net_img = NET_IMAGE_BASE.clone()
-		top = self.layer_images['top'].clone()
-		top.scale(121, 121)
-		net_img.composite(top, 59, 9)
-		middle = self.layer_images['middle'].clone()
-		middle.scale(228, 62)
-		net_img.composite(middle, 6, 138)
-		bottom = self.layer_images['bottom'].clone()
-		bottom.scale(228, 26)
-		net_img.composite(bottom, 6, 206)
-		net_img.composite(self.net_image_mask, 0, 0)
-		return net_img
+	net_image_layout = [
+		NetImagePlacement('top', (59, 9), (121, 121)),
+		NetImagePlacement('middle', (6, 138), (228, 62)),
+		NetImagePlacement('bottom', (6, 206), (228, 26)),
+	]
 
 with open('data/preview image.jpg', 'rb') as f:
 	dummy_preview_image = f.read()
 
-LITTLE_ENDIAN_UINT32 = struct.Struct('>L')
-TWO_LITTLE_ENDIAN_UINT32S = struct.Struct('>LL')
-
 DUMMY_EXTRA_METADATA = {
 	'mAuthor': {
 		'mVId': 4255292630,
@@ -556,6 +565,9 @@ def tile(image):
 
 # TODO make this a method of Design
 def encode(design: Design) -> dict:
+	# importing utils loads config.toml, which nothing else in this module needs
+	from utils import config
+
 	encoded = {}
 	meta = {
 		'mMtVNm': design.island_name,
@@ -608,52 +620,46 @@ def encode_basic(design):
 
 def encode_pro(design):
 	design.validate()
-	pxss = [memoryview(bytearray(image.export_pixels())) for image in design.internalize()]
+	pxss = [pixels.tobytes() for pixels in design.internalize_arrays()]
 	img_data = encode_image_data(pxss)
 	return False, img_data
 
 def encode_image_data(pxss: List[bytes]) -> dict:
-	palette = gen_palette(pxss)
-	layers = {}
-	for i, pxs in enumerate(pxss):
-		layers[str(i)] = encode_image(palette, pxs)
+	palette, layers = gen_palette(pxss)
 
 	img_data = {}
-	palette = img_data['mPalette'] = {str(i): color for color, i in palette.items()}
-
-	img_data['mData'] = layers
+	img_data['mPalette'] = {str(i): color for i, color in enumerate(palette)}
+	# implicit transparent
+	img_data['mPalette'][str(PALETTE_SIZE)] = 0
+	img_data['mData'] = {str(i): encode_image(indices) for i, indices in enumerate(layers)}
 	img_data.update(DUMMY_EXTRA_METADATA)
 
 	return img_data
 
-def gen_palette(pxss: List[bytes], *, pro=False) -> Dict[int, int]:
-	palette = {}
-	color_i = 0
-	for pxs in pxss:
-		for px in utils.chunked(pxs, 4):
-			color, = LITTLE_ENDIAN_UINT32.unpack(px)
-			if color not in palette:
-				palette[color] = color_i
-				color_i += 1
-
-	if pro:
-		palette_max = PALETTE_SIZE
-	else:
-		palette_max = PALETTE_SIZE + 1
-		# implicit transparent
-		palette[0] = PALETTE_SIZE
-
-	if len(palette) > palette_max:
+def gen_palette(pxss: List[bytes]) -> Tuple[List[int], List[np.ndarray]]:
+	"""Index the colors of every layer at once.
+	Returns the opaque colors, and for each layer an array of indices into them.
+	Fully transparent pixels get index PALETTE_SIZE.
+	"""
+	pixels = np.concatenate([np.frombuffer(pxs, dtype='>u4') for pxs in pxss])
+	colors, inverse = np.unique(pixels, return_inverse=True)
+
+	opaque = colors != 0
+	num_colors = int(np.count_nonzero(opaque))
+	if num_colors > PALETTE_SIZE:
 		raise InvalidPaletteError
 
-	return palette
+	lut = np.full(len(colors), PALETTE_SIZE, dtype=np.uint8)
+	lut[opaque] = np.arange(num_colors)
+	indices = lut[inverse.reshape(-1)]
+
+	layer_lengths = [len(pxs) // BYTES_PER_PIXEL for pxs in pxss]
+	return colors[opaque].tolist(), np.split(indices, np.cumsum(layer_lengths)[:-1])
 
-def encode_image(palette, pxs):
-	img = io.BytesIO()
-	for pixels in utils.chunked(pxs, 8):
-		px1, px2 = TWO_LITTLE_ENDIAN_UINT32S.unpack_from(pixels)
-		img.write((palette[px2] << 4 | palette[px1]).to_bytes(1, byteorder='big'))
-	return img.getvalue()
+def encode_image(indices: np.ndarray) -> bytes:
+	pairs = indices.reshape(-1, 2)
+	# the first pixel goes in the low nibble
+	return (pairs[:, 1] << 4 | pairs[:, 0]).tobytes()
 
 def maybe_quantize(image):
 	was_quantized = False
@@ -0,0 +1,189 @@
+# © 2020 io mintz <io@mintz.cc>
+
+"""The parts of design rendering that only need numpy, so that they can be used and tested without ImageMagick."""
+
+import contextlib
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple, Union, TYPE_CHECKING
+
+import numpy as np
+
+from .format import BYTES_PER_PIXEL, PALETTE_SIZE
+
+if TYPE_CHECKING:
+	from .encode import Layer
+
+XY = Tuple[int, int]
+
+# index of the implicitly transparent palette entry of designs
+TRANSPARENT_INDEX = PALETTE_SIZE
+
+@dataclass(frozen=True)
+class IndexedImage:
+	"""An image stored the way designs store it: a palette of RGBA colors and a plane of indices into it.
+	A quarter the size of the equivalent RGBA array, and it never has to have its colors counted again.
+	"""
+	# (num_colors, 4)
+	palette: np.ndarray
+	# (height, width)
+	indices: np.ndarray
+
+	def to_rgba(self) -> np.ndarray:
+		return self.palette[self.indices]
+
+# whichever of the two a layer happens to be available as
+Pixels = Union[IndexedImage, np.ndarray]
+
+def as_rgba(pixels: Pixels) -> np.ndarray:
+	"""Return pixels as a (height, width, 4) RGBA array, expanding it if it's indexed."""
+	if isinstance(pixels, IndexedImage):
+		return pixels.to_rgba()
+	return pixels
+
+def scale_nearest(pixels: Pixels, factor: int) -> Pixels:
+	"""Scale pixels up by an integer factor by repeating each one. Indexed images stay indexed."""
+	if isinstance(pixels, IndexedImage):
+		return IndexedImage(pixels.palette, scale_nearest(pixels.indices, factor))
+	return pixels.repeat(factor, axis=0).repeat(factor, axis=1)
+
+@dataclass
+class LayerCorrespondence:
+	internal_idx: int
+	external_name: str
+	internal_pos: XY
+	external_pos: XY
+	dimensions: XY
+
+	def compile(self, internal_layer: 'Layer', external_layer: 'Layer') -> Optional['CompiledCorrespondence']:
+		"""Turn this into slices of the two layers. Returns None if they don't overlap at all."""
+		(ix, iy), (ex, ey) = self.internal_pos, self.external_pos
+		# like compositing, anything that would go past the edge of either layer is dropped
+		width = min(self.dimensions[0], internal_layer.width - ix, external_layer.width - ex)
+		height = min(self.dimensions[1], internal_layer.height - iy, external_layer.height - ey)
+		if width <= 0 or height <= 0:
+			return None
+
+		return CompiledCorrespondence(
+			self.internal_idx,
+			self.external_name,
+			(slice(iy, iy + height), slice(ix, ix + width)),
+			(slice(ey, ey + height), slice(ex, ex + width)),
+		)
+
+@dataclass(frozen=True)
+class CompiledCorrespondence:
+	internal_idx: int
+	external_name: str
+	# (rows, columns) of each layer's pixel array
+	internal_slices: Tuple[slice, slice]
+	external_slices: Tuple[slice, slice]
+
+def composite_over(src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+	"""Alpha composite one RGBA array over another of the same shape, or over a single color."""
+	src_alpha = src[..., 3:] / 255
+	dst_alpha = dst[..., 3:] / 255 * (1 - src_alpha)
+	alpha = src_alpha + dst_alpha
+	rgb = (src[..., :3] * src_alpha + dst[..., :3] * dst_alpha) / np.where(alpha == 0, 1, alpha)
+	return np.concatenate([rgb, alpha * 255], axis=-1).round().astype(np.uint8)
+
+NET_IMAGE_SIZE = (240, 240)
+
+@dataclass(frozen=True)
+class NetImagePlacement:
+	"""Where to draw an external layer on the net image. It is scaled to size with nearest neighbour sampling."""
+	layer_name: str
+	position: XY
+	size: XY
+
+class NetImagePlan:
+	"""A net image layout, compiled into a lookup table from each pixel of the net image to the layer pixel drawn there.
+
+	Drawing the net image is then a single gather from all of the layers' pixels at once.
+	Placements are not composited over each other, so they must not overlap.
+	"""
+	MAX_TABLES = 16
+
+	def __init__(self, placements: List[NetImagePlacement], *, background=None, mask=None):
+		"""background is an RGBA color to draw the layers over. mask is an RGBA array drawn over the layers."""
+		self.placements = placements
+		self.layer_names = list(dict.fromkeys(placement.layer_name for placement in placements))
+		self.background = None if background is None else np.array(background, dtype=np.uint8)
+		self.mask = mask
+		if mask is not None:
+			# the mask is mostly transparent, so only composite the pixels where it isn't
+			self._mask_pixels = np.flatnonzero(mask[..., 3])
+			self._mask = mask.reshape(-1, BYTES_PER_PIXEL)[self._mask_pixels]
+		# layer sizes -> index table. almost always just the sizes of the class's external layers,
+		# but basic images can be any size.
+		self._tables = {}
+		self._lock = threading.Lock()
+
+	def compile(self, sizes: Tuple[XY, ...]) -> np.ndarray:
+		"""Return a table of indices into the concatenated pixels of layers of the given sizes.
+		Index 0 is a transparent pixel which is drawn wherever no layer is placed.
+		"""
+		with contextlib.suppress(KeyError):
+			return self._tables[sizes]
+
+		offsets = {}
+		offset = 1
+		for name, (width, height) in zip(self.layer_names, sizes):
+			offsets[name] = offset, width, height
+			offset += width * height
+
+		table = np.zeros(NET_IMAGE_SIZE[::-1], dtype=np.intp)
+		for placement in self.placements:
+			offset, width, height = offsets[placement.layer_name]
+			(x, y), (target_width, target_height) = placement.position, placement.size
+			# sample the center of each target pixel
+			src_y = (np.arange(target_height) * 2 + 1) * height // (target_height * 2)
+			src_x = (np.arange(target_width) * 2 + 1) * width // (target_width * 2)
+			table[y:y + target_height, x:x + target_width] = offset + src_y[:, None] * width + src_x
+
+		with self._lock:
+			if len(self._tables) >= self.MAX_TABLES:
+				# forget the oldest one
+				del self._tables[next(iter(self._tables))]
+			self._tables[sizes] = table
+		return table
+
+	def _gather(self, layers: Dict[str, np.ndarray], blank: np.ndarray) -> np.ndarray:
+		"""Gather the net image from layers, which are all RGBA or all palette indices. blank is the one pixel
+		drawn where no layer is placed.
+		"""
+		sizes = tuple((layers[name].shape[1], layers[name].shape[0]) for name in self.layer_names)
+		pixels = np.concatenate([blank] + [layers[name].reshape(-1, *blank.shape[1:]) for name in self.layer_names])
+		return pixels[self.compile(sizes)]
+
+	def _draw_mask(self, out: np.ndarray):
+		flat = out.reshape(-1, BYTES_PER_PIXEL)
+		flat[self._mask_pixels] = composite_over(self._mask, flat[self._mask_pixels])
+
+	def draw(self, layers: Dict[str, np.ndarray]) -> np.ndarray:
+		"""Draw the net image from the RGBA pixels of each layer."""
+		out = self._gather(layers, np.zeros((1, BYTES_PER_PIXEL), dtype=np.uint8))
+
+		if self.background is not None:
+			flat = out.reshape(-1, BYTES_PER_PIXEL)
+			# opaque pixels hide the background anyway
+			translucent = np.flatnonzero(flat[:, 3] != 0xFF)
+			flat[translucent] = composite_over(flat[translucent], self.background)
+		if self.mask is not None:
+			self._draw_mask(out)
+		return out
+
+	def draw_indexed(self, palette: np.ndarray, layers: Dict[str, np.ndarray]) -> Pixels:
+		"""Draw the net image from layers of indices into palette.
+		Stays indexed unless there is a mask, which adds colors of its own.
+		"""
+		indices = self._gather(layers, np.array([TRANSPARENT_INDEX], dtype=np.uint8))
+		if self.background is not None:
+			# the background is one color, so drawing over it only changes the palette
+			palette = composite_over(palette, self.background)
+		if self.mask is None:
+			return IndexedImage(palette, indices)
+
+		out = palette[indices]
+		self._draw_mask(out)
+		return out
@@ -1,11 +1,11 @@
 # © 2020 io mintz
 # Based on code provided by Nick Wanninger, however io mintz retains all copyright ownership.
 
-import io
-import wand.image
+import numpy as np
 
 from .encode import Design
-from .format import WIDTH, HEIGHT
+from .pixels import IndexedImage, Pixels
+from .format import WIDTH, HEIGHT, BYTES_PER_PIXEL, PALETTE_SIZE
 from ..errors import InvalidLayerIndexError, InvalidLayerNameError
 
 def gen_palette(raw_image):
@@ -16,42 +16,39 @@ def gen_palette(raw_image):
 	palette[0xF] = 0
 	return palette
 
-def _render_layer(raw_image, palette, layer) -> wand.image.Image:
-	palette = gen_palette(raw_image)
-
-	im = wand.image.Image(width=WIDTH, height=HEIGHT)
-
-	out = io.BytesIO()
-
-	for byte in layer:
-		b1 = byte & 0xF
-		b2 = (byte >> 4) & 0xF
-
-		for nibble in b1, b2:
-			out.write(palette[nibble].to_bytes(4, byteorder='big'))
-
-	out.seek(0)
-	im.import_pixels(channel_map='RGBA', data=out.getbuffer())
-	return im
-
-def render_layer(raw_image, layer_i: int) -> wand.image.Image:
+def palette_table(raw_image) -> np.ndarray:
+	"""Return a 16×4 RGBA lookup table for the palette of raw_image, indexable by nibble."""
+	table = np.zeros(PALETTE_SIZE + 1, dtype='>u4')
+	for i, color in gen_palette(raw_image).items():
+		table[i] = color
+	return table.view(np.uint8).reshape(-1, BYTES_PER_PIXEL)
+
+def unpack_indices(layers) -> np.ndarray:
+	"""Split nibble packed layers into an array of palette indices with shape (len(layers), HEIGHT, WIDTH)."""
+	packed = np.frombuffer(b''.join(layers), dtype=np.uint8).reshape(len(layers), -1)
+	indices = np.empty((packed.shape[0], packed.shape[1] * 2), dtype=np.uint8)
+	# the low nibble is the first pixel
+	indices[:, 0::2] = packed & 0xF
+	indices[:, 1::2] = packed >> 4
+	return indices.reshape(len(layers), HEIGHT, WIDTH)
+
+def render_layer(raw_image, layer_i: int) -> IndexedImage:
 	try:
 		layer = raw_image['mData'][str(layer_i)]
 	except KeyError:
 		raise InvalidLayerIndexError(num_layers=len(raw_image['mData']))
 
-	return _render_layer(raw_image, gen_palette(raw_image), layer)
+	return IndexedImage(palette_table(raw_image), unpack_indices([layer])[0])
 
-def render_layer_name(data, layer_name) -> wand.image.Image:
+def render_layer_name(data, layer_name) -> Pixels:
 	design = Design.from_data(data)
 	try:
-		return design.layer_images[layer_name]
+		return design.layer_pixels()[layer_name]
 	except KeyError:
 		raise InvalidLayerNameError(design)
 
 def render_layers(raw_image):
-	palette = gen_palette(raw_image)
-	# idk there's probably some python nerd `map` thing you can do here I'm a
-	# C programmer so I like the word `for` more than that functional nonsense
-	for layer_i, layer in raw_image['mData'].items():
-		yield int(layer_i), _render_layer(raw_image, palette, layer)
+	"""Yield the index and IndexedImage of each layer of raw_image. The layers share one palette."""
+	palette = palette_table(raw_image)
+	for layer_i, indices in zip(raw_image['mData'], unpack_indices(list(raw_image['mData'].values()))):
+		yield int(layer_i), IndexedImage(palette, indices)
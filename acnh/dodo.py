@@ -1,13 +1,23 @@
 # © 2020 io mintz <io@mintz.cc>
 
-import datetime as dt
+import contextlib
+import threading
+import time
+from typing import Dict, List, Optional
 
 from nintendo.nex import matchmaking
+from nintendo.nex.common import RMCError
 
-from .common import backend
-from .errors import UnknownDodoCodeError, InvalidDodoCodeError
+from .common import backend, discard_backend
+from .errors import UnknownDodoCodeError, InvalidDodoCodeError, TooManyDodoCodesError
 
-# _search_dodo_code is based on code provided by Yannik Marchand under the MIT License.
+# dodo codes are polled a lot, but sessions come and go, so don't cache them for long
+DODO_CODE_CACHE_DURATION = 15
+# dodo_code: (session info or None if unknown, time cached)
+_cache = {}
+_cache_lock = threading.Lock()
+
+# _search_dodo_codes, _search_criteria and _session_info are based on code provided by Yannik Marchand under the MIT License.
 # Copyright (c) 2017 Yannik Marchand
 
 # Permission is hereby granted, free of charge, to any person obtaining a copy
@@ -29,10 +39,71 @@ from .errors import UnknownDodoCodeError, InvalidDodoCodeError
 # SOFTWARE.
 
 def search_dodo_code(dodo_code: str):
-	InvalidDodoCodeError.validate(dodo_code)
+	info = search_dodo_codes([dodo_code])[dodo_code]
+	if info is None:
+		raise UnknownDodoCodeError
+	return info
+
+def search_dodo_codes(dodo_codes: List[str]) -> Dict[str, Optional[dict]]:
+	"""Look up several dodo codes over one game server session.
+	Returns a dict mapping each dodo code to its session info, or None if there's no such session.
+	"""
+	TooManyDodoCodesError.validate(dodo_codes)
+	for dodo_code in dodo_codes:
+		InvalidDodoCodeError.validate(dodo_code)
+
+	now = time.time()
+	results = {}
+	with _cache_lock:
+		for dodo_code in dodo_codes:
+			with contextlib.suppress(KeyError):
+				info, cached_at = _cache[dodo_code]
+				if now - cached_at < DODO_CODE_CACHE_DURATION:
+					results[dodo_code] = info
+
+	missing = [dodo_code for dodo_code in dodo_codes if dodo_code not in results]
+	if not missing:
+		return results
+
+	try:
+		found = _search_dodo_codes(missing)
+	except (ConnectionError, RMCError):
+		# the pooled session probably expired or got disconnected. try again with a fresh one.
+		discard_backend()
+		found = _search_dodo_codes(missing)
+
+	now = time.time()
+	with _cache_lock:
+		for dodo_code, info in found.items():
+			_cache[dodo_code] = info, now
+		_prune_cache(now)
 
+	results.update(found)
+	return results
+
+def _prune_cache(now):
+	for dodo_code, (_, cached_at) in list(_cache.items()):
+		if now - cached_at >= DODO_CODE_CACHE_DURATION:
+			del _cache[dodo_code]
+
+def _search_dodo_codes(dodo_codes):
 	mm = matchmaking.MatchmakeExtensionClient(backend().secure_client)
+	results = {}
+	for dodo_code in dodo_codes:
+		sessions = mm.browse_matchmake_session_no_holder_no_result_range(_search_criteria(dodo_code))
+		results[dodo_code] = _session_info(sessions[0]) if sessions else None
+	return results
+
+def _session_info(session):
+	data = session.application_data
+	return dict(
+		active_players=session.player_count,
+		name=data[12:32].decode('utf-16').rstrip('\0'),
+		host=data[40:60].decode('utf-16').rstrip('\0'),
+		start_time=session.started_time.to_standard_datetime(),
+	)
 
+def _search_criteria(dodo_code):
 	param = matchmaking.MatchmakeSessionSearchCriteria()
 	param.attribs = ['', '', '', '', '', '']
 	param.game_mode = '2'
@@ -49,15 +120,4 @@ def search_dodo_code(dodo_code: str):
 	param.refer_gid = 0
 	param.codeword = dodo_code
 
-	sessions = mm.browse_matchmake_session_no_holder_no_result_range(param)
-	if not sessions:
-		raise UnknownDodoCodeError
-
-	session = sessions[0]
-	data = session.application_data
-	return dict(
-		active_players=session.player_count,
-		name=data[12:32].decode('utf-16').rstrip('\0'),
-		host=data[40:60].decode('utf-16').rstrip('\0'),
-		start_time=session.started_time.to_standard_datetime(),
-	)
+	return param
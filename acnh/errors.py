@@ -48,6 +48,18 @@ class InvalidDodoCodeError(DodoCodeError, InvalidFormatError):
 	message = 'invalid dodo code'
 	regex = re.compile(r'[A-HJ-NP-Y0-9]{5}')
 
+class TooManyDodoCodesError(DodoCodeError):
+	code = 103
+	message = 'at most {0.max_dodo_codes} dodo codes may be looked up at once'
+	http_status = HTTPStatus.BAD_REQUEST
+	max_dodo_codes = 10
+
+	@classmethod
+	def validate(cls, dodo_codes):
+		if len(dodo_codes) > cls.max_dodo_codes:
+			raise cls
+		return dodo_codes
+
 class ImageError(ACNHError):
 	pass
 
@@ -136,6 +148,21 @@ class InvalidPaletteError(DesignError):
 class DesignLitTheServerOnFireError(InvalidDesignError, DesignError):
 	code = 212
 
+class DesignTimeoutError(DesignError):
+	code = 213
+	message = 'timed out waiting for the design to be downloaded or rendered'
+	http_status = HTTPStatus.GATEWAY_TIMEOUT
+
+class InvalidScaleFilterError(InvalidFormatError):
+	message = 'invalid scale filter'
+	code = 214
+	regex = re.compile(r'nearest|xbrz')
+
+class ScalingRequiresAuthorizationError(DesignError):
+	code = 215
+	message = 'this scale factor and filter require authorization'
+	http_status = HTTPStatus.UNAUTHORIZED
+
 class UnknownImageIdError(ImageError):
 	code = 301
 	message = 'unknown image ID'
@@ -250,6 +277,16 @@ class ImageNameTooLongError(ImageError):
 		d['max_length'] = self.max_len
 		return d
 
+class UploadFailedError(ImageError):
+	code = 313
+	message = 'An unexpected error occurred while uploading the image.'
+	http_status = HTTPStatus.INTERNAL_SERVER_ERROR
+
+class UploadTimeoutError(ImageError):
+	code = 314
+	message = 'Timed out waiting for the image to be uploaded. It is still queued, so check its progress again later.'
+	http_status = HTTPStatus.GATEWAY_TIMEOUT
+
 class InvalidPaginationError(ACNHError):
 	http_status = HTTPStatus.BAD_REQUEST
 
@@ -278,3 +315,8 @@ class IncorrectAuthorizationError(AuthorizationError):
 	def __init__(self, path=None):
 		self.path = path
 		super().__init__()
+
+class DatabaseBusyError(ACNHError):
+	code = 903
+	message = 'the server is too busy right now. try again later'
+	http_status = HTTPStatus.SERVICE_UNAVAILABLE
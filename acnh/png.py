@@ -0,0 +1,98 @@
+# © 2020 io mintz <io@mintz.cc>
+
+"""A minimal PNG encoder for the small, few-colored images that designs are made of.
+
+Designs have at most 16 colors, so palette PNGs are much smaller than RGBA ones,
+and writing them directly is a lot cheaper than going through ImageMagick.
+"""
+
+import struct
+import zlib
+
+import numpy as np
+
+SIGNATURE = b'\x89PNG\r\n\x1a\n'
+MAX_PALETTE_SIZE = 256
+
+COLOR_TYPE_PALETTE = 3
+COLOR_TYPE_RGBA = 6
+
+COMPRESSION_LEVEL = 6
+
+def _chunk(type: bytes, data: bytes) -> bytes:
+	return struct.pack('>I', len(data)) + type + data + struct.pack('>I', zlib.crc32(type + data))
+
+def _ihdr(width, height, bit_depth, color_type) -> bytes:
+	# compression, filter and interlace methods are always 0
+	return _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, bit_depth, color_type, 0, 0, 0))
+
+def _idat(rows: np.ndarray) -> bytes:
+	# each scanline is prefixed with its filter type. filter 0 (none) compresses best for indexed images.
+	filtered = np.zeros((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+	filtered[:, 1:] = rows
+	return _chunk(b'IDAT', zlib.compress(filtered.tobytes(), COMPRESSION_LEVEL))
+
+def bit_depth(num_colors) -> int:
+	for depth in (1, 2, 4):
+		if num_colors <= 1 << depth:
+			return depth
+	return 8
+
+def pack_indices(indices: np.ndarray, depth: int) -> np.ndarray:
+	"""Pack a (height, width) array of palette indices into scanlines of depth bits per pixel."""
+	if depth == 8:
+		return indices.astype(np.uint8, copy=False)
+
+	height, width = indices.shape
+	per_byte = 8 // depth
+	padded = np.zeros((height, -(-width // per_byte) * per_byte), dtype=np.uint8)
+	padded[:, :width] = indices
+	padded = padded.reshape(height, -1, per_byte)
+	# the leftmost pixel goes in the most significant bits
+	shifts = np.arange(8 - depth, -1, -depth, dtype=np.uint8)
+	return np.bitwise_or.reduce(padded << shifts, axis=2)
+
+def encode_indexed(palette: np.ndarray, indices: np.ndarray) -> bytes:
+	"""Encode a palette PNG. palette is an (n, 4) array of RGBA colors and indices is a (height, width) array."""
+	height, width = indices.shape
+	depth = bit_depth(len(palette))
+
+	opaque = palette[:, 3] == 0xFF
+	if not opaque.all() and opaque[:np.count_nonzero(~opaque)].any():
+		# move the translucent entries to the front so that tRNS only has to list those
+		order = np.argsort(opaque, kind='stable')
+		palette = palette[order]
+		lut = np.empty(len(order), dtype=np.uint8)
+		lut[order] = np.arange(len(order))
+		indices = lut[indices]
+
+	out = [SIGNATURE, _ihdr(width, height, depth, COLOR_TYPE_PALETTE)]
+	out.append(_chunk(b'PLTE', np.ascontiguousarray(palette[:, :3]).tobytes()))
+
+	alpha = palette[:, 3]
+	translucent = np.flatnonzero(alpha != 0xFF)
+	if translucent.size:
+		# trailing opaque entries may be left out
+		out.append(_chunk(b'tRNS', alpha[:translucent[-1] + 1].tobytes()))
+
+	out.append(_idat(pack_indices(indices, depth)))
+	out.append(_chunk(b'IEND', b''))
+	return b''.join(out)
+
+def encode_rgba(pixels: np.ndarray) -> bytes:
+	"""Encode a (height, width, 4) RGBA array as a PNG. Uses a palette if there are few enough colors."""
+	height, width, _ = pixels.shape
+	colors, indices = np.unique(
+		np.ascontiguousarray(pixels).view('>u4').reshape(-1),
+		return_inverse=True,
+	)
+	if len(colors) <= MAX_PALETTE_SIZE:
+		palette = colors.view(np.uint8).reshape(-1, 4)
+		return encode_indexed(palette, indices.reshape(height, width))
+
+	return b''.join([
+		SIGNATURE,
+		_ihdr(width, height, 8, COLOR_TYPE_RGBA),
+		_idat(np.ascontiguousarray(pixels).reshape(height, width * 4)),
+		_chunk(b'IEND', b''),
+	])
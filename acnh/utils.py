@@ -1,46 +1,111 @@
 # © 2020 io mintz <io@mintz.cc>
 
+import contextlib
+import fcntl
+import os
 import os.path
+import tempfile
+import threading
 import time
+from typing import Optional
 
-# pylint: disable=dangerous-default-value
-def load_cached(path, callback, *, duration=23 * 60 * 60, binary=False, _cache={}):
+# path -> (value, mtime of the file it was read from)
+_cache = {}
+
+# refresh values this long before they expire, so that requests don't have to wait for them
+REFRESH_MARGIN = 5 * 60
+
+def load_cached(path, callback, *, duration=23 * 60 * 60, binary=False, refresh_margin=REFRESH_MARGIN):
+	"""Return the value stored at path, calling callback to replace it if it is older than duration seconds.
+
+	The file is shared between processes. Refreshes are serialized with a lock file next to it,
+	so that when a value expires only one process calls callback and the rest wait for its result.
+	Within refresh_margin seconds of expiring, whichever process gets the lock first refreshes it
+	and the others keep using the old value in the meantime.
+	"""
 	now = time.time()
+	with contextlib.suppress(FileNotFoundError):
+		rv, last_modified = _read_cached(path, binary)
+		age = now - last_modified
+		if age < duration - refresh_margin:
+			return rv
+		if age < duration:
+			# still valid, so only refresh it if no one else is already
+			with _file_lock(path, blocking=False) as locked:
+				if locked:
+					return _refresh_cached(path, callback, duration=duration - refresh_margin, binary=binary)
+			return rv
 
-	def refresh_cache():
-		rv = callback()
-		with open(path, 'wb' if binary else 'w') as f:
-			f.write(rv)
-		_cache[path] = rv, now
-		return rv
+	with _file_lock(path):
+		return _refresh_cached(path, callback, duration=duration, binary=binary)
 
+def _read_cached(path, binary):
+	last_modified = os.stat(path).st_mtime
 	try:
-		rv, last_modified = _cache[path]
+		rv, cached_last_modified = _cache[path]
 	except KeyError:
 		pass
 	else:
-		if now - last_modified > duration:
-			return refresh_cache()
-		return rv
+		# someone else may have replaced the file since we last read it
+		if cached_last_modified == last_modified:
+			return rv, last_modified
+
+	with open(path, 'rb' if binary else 'r') as f:
+		# fstat in case it was replaced in between
+		last_modified = os.fstat(f.fileno()).st_mtime
+		rv = f.read()
+	_cache[path] = rv, last_modified
+	return rv, last_modified
 
-	# not in cache
+def _refresh_cached(path, callback, *, duration, binary):
+	# must be called with the lock held
+	# another process may have refreshed it while we were waiting for the lock
+	with contextlib.suppress(FileNotFoundError):
+		rv, last_modified = _read_cached(path, binary)
+		if time.time() - last_modified < duration:
+			return rv
 
+	rv = callback()
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
 	try:
-		last_modified = os.stat(path).st_mtime
-	except FileNotFoundError:
-		return refresh_cache()
+		with os.fdopen(fd, 'wb' if binary else 'w') as f:
+			f.write(rv)
+		# atomic so that other processes never read a partially written value
+		os.replace(tmp_path, path)
+	except BaseException:
+		with contextlib.suppress(FileNotFoundError):
+			os.remove(tmp_path)
+		raise
+	_cache[path] = rv, os.stat(path).st_mtime
+	return rv
 
-	# not in cache but file exists
+@contextlib.contextmanager
+def _file_lock(path, *, blocking=True):
+	"""Lock path across processes and threads. Yields whether the lock was acquired."""
+	with open(path + '.lock', 'a') as f:
+		try:
+			fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+		except BlockingIOError:
+			yield False
+			return
+		try:
+			yield True
+		finally:
+			fcntl.flock(f, fcntl.LOCK_UN)
 
-	if now - last_modified > duration:
-		return refresh_cache()
+def cached_age(path) -> Optional[float]:
+	"""Return how many seconds ago the value stored at path was refreshed, or None if there isn't one."""
+	try:
+		return time.time() - os.stat(path).st_mtime
+	except FileNotFoundError:
+		return None
 
-	# not in cache, file exists, and the file is young enough
-
-	with open(path, 'rb' if binary else 'r') as f:
-		rv = f.read()
-	_cache[path] = rv, now
-	return rv
+def invalidate_cached(path):
+	"""Forget a value stored by load_cached, so that the next call refreshes it."""
+	with _file_lock(path):
+		_cache.pop(path, None)
+		with contextlib.suppress(FileNotFoundError):
+			os.remove(path)
 
 def chunked(seq, n):
 	length = len(seq)
@@ -49,3 +114,57 @@ def chunked(seq, n):
 	mod = len(seq) % n
 	if mod:
 		yield seq[-mod:]
+
+def _copy_exception(ex: BaseException) -> BaseException:
+	"""Return an exception of the same type and with the same attributes as ex, without calling its __init__."""
+	copy = type(ex).__new__(type(ex), *ex.args)
+	copy.__dict__.update(ex.__dict__)
+	return copy
+
+class SingleFlight:
+	"""Coalesce concurrent calls that share a key into one call.
+
+	The first caller for a key runs the function. Everyone else who asks for the same key while it is running
+	waits up to timeout seconds for it, then gets the same return value, or a copy of the same exception.
+	If the wait times out, timeout_error is raised instead.
+	"""
+	class _Call:
+		__slots__ = ('done', 'result', 'exception')
+
+		def __init__(self):
+			self.done = threading.Event()
+			self.result = None
+			self.exception = None
+
+	def __init__(self, *, timeout=None, timeout_error=TimeoutError):
+		self.timeout = timeout
+		self.timeout_error = timeout_error
+		self._calls = {}
+		self._lock = threading.Lock()
+
+	def do(self, key, func, *args, **kwargs):
+		with self._lock:
+			call = self._calls.get(key)
+			leader = call is None
+			if leader:
+				call = self._calls[key] = self._Call()
+
+		if not leader:
+			if not call.done.wait(self.timeout):
+				raise self.timeout_error
+			if call.exception is not None:
+				# every waiter raising the same object would have them all overwrite its __traceback__ at once
+				raise _copy_exception(call.exception) from call.exception
+			return call.result
+
+		try:
+			call.result = func(*args, **kwargs)
+		except BaseException as ex:
+			call.exception = ex
+			raise
+		finally:
+			with self._lock:
+				del self._calls[key]
+			call.done.set()
+
+		return call.result
@@ -42,11 +42,87 @@ DELETE FROM designs
 WHERE design_id = ANY ($1)
 -- :endmacro
 
+-- :macro used_design_slots()
+-- params: creator_id, pro
+SELECT
+	count(*)
+	+ (SELECT count(*) FROM design_deletions WHERE creator_id = $1 AND pro = $2)
+	+ coalesce((SELECT untracked_designs FROM design_slots WHERE creator_id = $1 AND pro = $2), 0)
+FROM designs
+WHERE creator_id = $1 AND pro = $2
+-- :endmacro
+
+-- :macro account_last_used()
+-- params: creator_ids, pro
+-- accounts which have no designs are not returned
+SELECT creator_id, max(created_at) AS last_used
+FROM designs
+WHERE creator_id = ANY ($1) AND pro = $2
+GROUP BY creator_id
+-- :endmacro
+
+-- :macro delete_oldest_designs()
+-- params: creator_id, pro, limit
+DELETE FROM designs
+WHERE design_id IN (
+	SELECT design_id
+	FROM designs
+	WHERE creator_id = $1 AND pro = $2
+	ORDER BY created_at
+	LIMIT $3
+	-- so that concurrent garbage collections pick different designs
+	FOR UPDATE SKIP LOCKED
+)
+RETURNING design_id
+-- :endmacro
+
+-- :macro design_slots_reconciled_at()
+-- params: creator_id, pro
+SELECT reconciled_at
+FROM design_slots
+WHERE creator_id = $1 AND pro = $2
+-- :endmacro
+
+-- :macro delete_missing_designs()
+-- params: creator_id, pro, upstream_design_ids, created_before
+DELETE FROM designs
+WHERE creator_id = $1 AND pro = $2 AND design_id <> ALL ($3) AND created_at < $4
+RETURNING design_id
+-- :endmacro
+
+-- :macro count_untracked_designs()
+-- params: upstream_design_ids
+SELECT count(*)
+FROM unnest($1::BIGINT[]) AS upstream (design_id)
+WHERE
+	NOT EXISTS (SELECT 1 FROM designs WHERE designs.design_id = upstream.design_id)
+	AND NOT EXISTS (SELECT 1 FROM design_deletions WHERE design_deletions.design_id = upstream.design_id)
+-- :endmacro
+
+-- :macro untracked_designs()
+-- params: upstream_design_ids
+-- returns them in the same order
+SELECT design_id
+FROM unnest($1::BIGINT[]) WITH ORDINALITY AS upstream (design_id, i)
+WHERE
+	NOT EXISTS (SELECT 1 FROM designs WHERE designs.design_id = upstream.design_id)
+	AND NOT EXISTS (SELECT 1 FROM design_deletions WHERE design_deletions.design_id = upstream.design_id)
+ORDER BY i
+-- :endmacro
+
+-- :macro reconcile_design_slots()
+-- params: creator_id, pro, untracked_designs
+INSERT INTO design_slots (creator_id, pro, untracked_designs, reconciled_at)
+VALUES ($1, $2, $3, CURRENT_TIMESTAMP)
+ON CONFLICT (creator_id, pro) DO UPDATE
+SET untracked_designs = EXCLUDED.untracked_designs, reconciled_at = EXCLUDED.reconciled_at
+-- :endmacro
+
 -- :macro delete_image_designs()
 -- params: image_id
 DELETE FROM designs
 WHERE image_id = $1
-RETURNING design_id
+RETURNING design_id, creator_id, pro
 -- :endmacro
 
 -- :macro image_author_id()
@@ -60,6 +136,7 @@ WHERE image_id = $1
 -- params: image_id
 DELETE FROM images
 WHERE image_id = $1
+RETURNING pro
 -- :endmacro
 
 -- :macro create_image()
@@ -69,12 +146,17 @@ RETURNING image_id
 -- :endmacro
 
 -- :macro create_design()
--- params: image_id, design_id, position, pro
-INSERT INTO designs (image_id, design_id, position, pro)
-VALUES ($1, $2, $3, $4)
+-- params: image_id, design_id, position, pro, was_quantized, creator_id
+INSERT INTO designs (image_id, design_id, position, pro, was_quantized, creator_id)
+VALUES ($1, $2, $3, $4, $5, $6)
 RETURNING design_id
 -- :endmacro
 
+-- :macro image_exists()
+-- params: image_id
+SELECT EXISTS (SELECT 1 FROM images WHERE image_id = $1)
+-- :endmacro
+
 -- :macro image()
 -- params: image_id
 SELECT *
@@ -98,7 +180,8 @@ SELECT
 	designs_required,
 	type_code,
 	design_id,
-	position
+	position,
+	creator_id
 FROM
 	images
 	LEFT JOIN designs USING (image_id)
@@ -114,8 +197,82 @@ WHERE image_id = $1
 ORDER BY position
 -- :endmacro
 
+-- :macro queue_design_deletions()
+-- params: design_ids, creator_id, pro, attempts
+INSERT INTO design_deletions (design_id, creator_id, pro, attempts)
+SELECT unnest($1::BIGINT[]), $2, $3, $4
+ON CONFLICT (design_id) DO NOTHING
+-- :endmacro
+
+-- :macro claim_design_deletions()
+-- params: limit
+DELETE FROM design_deletions
+WHERE design_id IN (
+	SELECT design_id
+	FROM design_deletions
+	ORDER BY queued_at
+	LIMIT $1
+	FOR UPDATE SKIP LOCKED
+)
+RETURNING design_id, creator_id, pro, attempts
+-- :endmacro
+
 -- #endregion Designs
 
+-- #region Upload jobs
+
+-- :macro enqueue_upload()
+-- params: image_id
+-- returns nothing if it was already queued or running
+INSERT INTO upload_jobs (image_id)
+VALUES ($1)
+ON CONFLICT (image_id) DO UPDATE
+SET
+	status = 'queued',
+	error = NULL,
+	created_at = CURRENT_TIMESTAMP,
+	started_at = NULL,
+	finished_at = NULL
+-- if it's already queued or running, leave it alone
+WHERE upload_jobs.status IN ('done', 'failed')
+RETURNING image_id
+-- :endmacro
+
+-- :macro claim_upload()
+-- params: stale_after (seconds)
+UPDATE upload_jobs
+SET status = 'running', started_at = CURRENT_TIMESTAMP
+WHERE image_id = (
+	SELECT image_id
+	FROM upload_jobs
+	WHERE
+		status = 'queued'
+		-- the worker probably died
+		OR (status = 'running' AND started_at < CURRENT_TIMESTAMP - make_interval(secs => $1))
+	ORDER BY created_at
+	LIMIT 1
+	FOR UPDATE SKIP LOCKED
+)
+RETURNING image_id
+-- :endmacro
+
+-- :macro finish_upload()
+-- params: image_id, status, error
+UPDATE upload_jobs
+SET status = $2, error = $3, finished_at = CURRENT_TIMESTAMP
+WHERE image_id = $1
+-- :endmacro
+
+-- :macro upload_job()
+-- params: image_id
+-- status is NULL for images which have no upload job
+SELECT image_id, status, error
+FROM images LEFT JOIN upload_jobs USING (image_id)
+WHERE image_id = $1
+-- :endmacro
+
+-- #endregion Upload jobs
+
 -- #region Authorization
 
 -- :macro secret()
@@ -0,0 +1,58 @@
+-- upgrades a database made from an older schema.sql to the current one in place. safe to run more than once.
+-- existing designs are assumed to be on the account that acnh-design-creator-id in config.toml used to name,
+-- so pass that in:
+--   psql -v ON_ERROR_STOP=1 -v creator_id=<creator ID> -f schema-upgrade.sql <database>
+
+SET TIME ZONE 'UTC';
+
+BEGIN;
+
+ALTER TABLE designs ADD COLUMN IF NOT EXISTS was_quantized BOOLEAN NOT NULL DEFAULT FALSE;
+
+ALTER TABLE designs ADD COLUMN IF NOT EXISTS creator_id BIGINT;
+UPDATE designs SET creator_id = :creator_id WHERE creator_id IS NULL;
+ALTER TABLE designs ALTER COLUMN creator_id SET NOT NULL;
+
+DROP INDEX IF EXISTS oldest_designs;
+CREATE INDEX oldest_designs ON designs (creator_id, pro, created_at);
+
+CREATE TABLE IF NOT EXISTS design_deletions (
+	design_id BIGINT NOT NULL PRIMARY KEY,
+	creator_id BIGINT,
+	pro BOOLEAN NOT NULL,
+	attempts SMALLINT NOT NULL DEFAULT 0,
+	queued_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE design_deletions ADD COLUMN IF NOT EXISTS creator_id BIGINT;
+UPDATE design_deletions SET creator_id = :creator_id WHERE creator_id IS NULL;
+ALTER TABLE design_deletions ALTER COLUMN creator_id SET NOT NULL;
+
+-- this is only a count which gets recomputed by the next reconciliation, so it's simpler to start over
+DROP TABLE IF EXISTS design_slots;
+CREATE TABLE design_slots (
+	creator_id BIGINT NOT NULL,
+	pro BOOLEAN NOT NULL,
+	untracked_designs SMALLINT NOT NULL,
+	reconciled_at TIMESTAMP WITH TIME ZONE NOT NULL,
+	PRIMARY KEY (creator_id, pro)
+);
+
+DO $$ BEGIN
+	CREATE TYPE upload_status AS ENUM ('queued', 'running', 'done', 'failed');
+EXCEPTION WHEN duplicate_object THEN NULL;
+END $$;
+
+CREATE TABLE IF NOT EXISTS upload_jobs (
+	image_id INTEGER PRIMARY KEY REFERENCES images ON DELETE CASCADE,
+	status upload_status NOT NULL DEFAULT 'queued',
+	-- JSON encoded ACNHError, if it failed
+	error TEXT,
+	created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+	started_at TIMESTAMP WITH TIME ZONE,
+	finished_at TIMESTAMP WITH TIME ZONE
+);
+
+CREATE INDEX IF NOT EXISTS pending_upload_jobs ON upload_jobs (created_at) WHERE status IN ('queued', 'running');
+
+COMMIT;
@@ -44,10 +44,48 @@ CREATE TABLE designs (
 	-- what position is it in in the original image?
 	position SMALLINT NOT NULL,
 	created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-	pro BOOLEAN NOT NULL
+	pro BOOLEAN NOT NULL,
+	-- which creator account it was uploaded to
+	creator_id BIGINT NOT NULL,
+	-- did it have to be quantized to fit the game's palette size?
+	was_quantized BOOLEAN NOT NULL DEFAULT FALSE
 );
 
 CREATE INDEX design_sequence_idx ON designs (image_id, position);
 -- lets us find which ones to garbage collect
-CREATE INDEX oldest_designs ON designs (pro, created_at);
+CREATE INDEX oldest_designs ON designs (creator_id, pro, created_at);
 
+-- designs which still need to be deleted from Nintendo's servers. processed by upload_worker.py.
+CREATE TABLE design_deletions (
+	design_id BIGINT NOT NULL PRIMARY KEY,
+	creator_id BIGINT NOT NULL,
+	pro BOOLEAN NOT NULL,
+	attempts SMALLINT NOT NULL DEFAULT 0,
+	queued_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- design slots on each creator account which are used by designs not in the designs table,
+-- as of the last time we compared it to the designs which are actually on Nintendo's servers
+CREATE TABLE design_slots (
+	creator_id BIGINT NOT NULL,
+	pro BOOLEAN NOT NULL,
+	untracked_designs SMALLINT NOT NULL,
+	reconciled_at TIMESTAMP WITH TIME ZONE NOT NULL,
+	PRIMARY KEY (creator_id, pro)
+);
+
+
+CREATE TYPE upload_status AS ENUM ('queued', 'running', 'done', 'failed');
+
+-- images whose designs need to be uploaded. processed by upload_worker.py.
+CREATE TABLE upload_jobs (
+	image_id INTEGER PRIMARY KEY REFERENCES images ON DELETE CASCADE,
+	status upload_status NOT NULL DEFAULT 'queued',
+	-- JSON encoded ACNHError, if it failed
+	error TEXT,
+	created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+	started_at TIMESTAMP WITH TIME ZONE,
+	finished_at TIMESTAMP WITH TIME ZONE
+);
+
+CREATE INDEX pending_upload_jobs ON upload_jobs (created_at) WHERE status IN ('queued', 'running');
@@ -0,0 +1,117 @@
+# © 2020 io mintz <io@mintz.cc>
+
+# run from the repository root, like the app, since encode loads files in data/.
+# the parts that don't need ImageMagick are tested in test_pixels.py.
+
+import os.path
+
+import numpy as np
+import pytest
+
+pytest.importorskip('wand.image')
+
+from acnh.designs.encode import Design, BasicDesign, Coat, LongSleeveDress
+from acnh.designs.format import SIZE as STANDARD, BYTES_PER_PIXEL
+from acnh.designs.pixels import TRANSPARENT_INDEX
+
+design_types = list(Design.design_types.values())
+
+def reference_externalize(cls, internal_layers, fill=0):
+	"""Copy each correspondence with plain slices of the layers actually given, like compositing them would."""
+	if cls.correspondence is None:
+		return {layer.name: pixels for layer, pixels in zip(cls.external_layers, internal_layers)}
+
+	pixel_shape = internal_layers[0].shape[2:]
+	out = {
+		layer.name: np.full((layer.height, layer.width, *pixel_shape), fill, dtype=internal_layers[0].dtype)
+		for layer in cls.external_layers
+	}
+	for c in cls.correspondence:
+		(ix, iy), (ex, ey), (width, height) = c.internal_pos, c.external_pos, c.dimensions
+		src = internal_layers[c.internal_idx][iy:iy + height, ix:ix + width]
+		dst = out[c.external_name][ey:ey + height, ex:ex + width]
+		height, width = min(src.shape[0], dst.shape[0]), min(src.shape[1], dst.shape[1])
+		dst[:height, :width] = src[:height, :width]
+	return out
+
+def game_layer_sizes(cls):
+	"""The sizes of the internal layers that the game sends for cls."""
+	if cls.one_to_one:
+		return [layer.size for layer in cls.internal_layers]
+	return [STANDARD] * len(cls.internal_layers)
+
+@pytest.mark.parametrize('cls', design_types, ids=lambda cls: cls.name)
+def test_internal_layers_fit_game_layers(cls):
+	for layer, (width, height) in zip(cls.internal_layers, game_layer_sizes(cls)):
+		assert layer.width <= width and layer.height <= height
+
+@pytest.mark.parametrize('cls', design_types, ids=lambda cls: cls.name)
+def test_externalize_arrays_matches_reference(cls):
+	rng = np.random.default_rng(cls.type_code)
+	internal = [
+		rng.integers(0, 256, (height, width, BYTES_PER_PIXEL), dtype=np.uint8)
+		for width, height in game_layer_sizes(cls)
+	]
+	expected = reference_externalize(cls, internal)
+	actual = cls.externalize_arrays(internal)
+
+	assert actual.keys() == expected.keys()
+	for name, pixels in expected.items():
+		np.testing.assert_array_equal(actual[name], pixels, err_msg=name)
+
+@pytest.mark.parametrize('cls', design_types, ids=lambda cls: cls.name)
+def test_externalize_indexed_matches_reference(cls):
+	rng = np.random.default_rng(cls.type_code)
+	palette = rng.integers(0, 256, (TRANSPARENT_INDEX + 1, BYTES_PER_PIXEL), dtype=np.uint8)
+	palette[TRANSPARENT_INDEX] = 0
+	internal = [
+		rng.integers(0, TRANSPARENT_INDEX + 1, (height, width), dtype=np.uint8)
+		for width, height in game_layer_sizes(cls)
+	]
+	expected = reference_externalize(cls, [palette[indices] for indices in internal])
+	design = cls.externalize_indexed(palette, internal)
+
+	assert design.layer_pixels().keys() == expected.keys()
+	for name, pixels in expected.items():
+		np.testing.assert_array_equal(design.layer_pixels()[name].to_rgba(), pixels, err_msg=name)
+		np.testing.assert_array_equal(design.layer_arrays()[name], pixels, err_msg=name)
+
+# these used to declare their internal layers as the same size as their external ones, which cut off the sleeves
+@pytest.mark.parametrize('cls', [Coat, LongSleeveDress], ids=lambda cls: cls.name)
+def test_long_body_internal_layers(cls):
+	assert [layer.size for layer in cls.internal_layers] == [STANDARD] * 4
+	assert len(cls.compiled_correspondence) == len(cls.correspondence)
+	for c, compiled in zip(cls.correspondence, cls.compiled_correspondence):
+		rows, columns = compiled.internal_slices
+		assert (columns.stop - columns.start, rows.stop - rows.start) == c.dimensions
+
+@pytest.mark.parametrize('cls', [Coat, LongSleeveDress], ids=lambda cls: cls.name)
+def test_long_body_externalize(cls):
+	# fill each internal layer with its own index to see where each external pixel came from
+	internal = [np.full(STANDARD[::-1], i, dtype=np.uint8) for i in range(len(cls.internal_layers))]
+	external = cls.externalize_arrays(internal, fill=TRANSPARENT_INDEX)
+
+	assert (external['front'][:32] == 0).all() and (external['front'][32:] == 2).all()
+	assert (external['back'][:32] == 1).all() and (external['back'][32:] == 3).all()
+	assert (external['right-sleeve'] == 2).all()
+	assert (external['left-sleeve'] == 3).all()
+
+def known_basic_design():
+	"""A design with a gradient palette, one translucent color, and transparent stripes."""
+	palette = np.zeros((TRANSPARENT_INDEX + 1, BYTES_PER_PIXEL), dtype=np.uint8)
+	palette[:TRANSPARENT_INDEX, 0] = np.arange(TRANSPARENT_INDEX) * 17
+	palette[:TRANSPARENT_INDEX, 1] = 255 - np.arange(TRANSPARENT_INDEX) * 17
+	palette[:TRANSPARENT_INDEX, 2] = 0x40
+	palette[:TRANSPARENT_INDEX, 3] = 0xFF
+	palette[7, 3] = 0x80
+	y, x = np.mgrid[:32, :32]
+	indices = ((x // 2 + y // 3) % (TRANSPARENT_INDEX + 1)).astype(np.uint8)
+	return BasicDesign.externalize_indexed(palette, [indices])
+
+# checked against a per-pixel reference when it was made. if it has to be regenerated because thumbnails were
+# meant to change, also bump RENDER_VERSION in views/api.py.
+EXPECTED_BASIC_THUMBNAIL = os.path.join(os.path.dirname(__file__), 'data', 'basic-design-thumbnail.npz')
+
+def test_basic_design_thumbnail():
+	with np.load(EXPECTED_BASIC_THUMBNAIL) as expected:
+		np.testing.assert_array_equal(known_basic_design().net_image_array(), expected['thumbnail'])
@@ -0,0 +1,100 @@
+# © 2020 io mintz <io@mintz.cc>
+
+import numpy as np
+import pytest
+
+from acnh.designs.format import BYTES_PER_PIXEL, PALETTE_SIZE
+from acnh.designs.pixels import (
+	TRANSPARENT_INDEX,
+	IndexedImage,
+	LayerCorrespondence,
+	NET_IMAGE_SIZE,
+	NetImagePlacement,
+	NetImagePlan,
+	as_rgba,
+	composite_over,
+	scale_nearest,
+)
+
+class Size:
+	"""Stands in for encode.Layer, which needs ImageMagick. Only the size is used."""
+	def __init__(self, width, height):
+		self.width, self.height = width, height
+
+def random_palette(rng):
+	palette = rng.integers(0, 256, (TRANSPARENT_INDEX + 1, BYTES_PER_PIXEL), dtype=np.uint8)
+	palette[TRANSPARENT_INDEX] = 0
+	return palette
+
+def test_scale_nearest():
+	indices = np.array([[0, 1], [2, 3]], dtype=np.uint8)
+	palette = np.arange(4 * BYTES_PER_PIXEL, dtype=np.uint8).reshape(4, BYTES_PER_PIXEL)
+
+	scaled = scale_nearest(IndexedImage(palette, indices), 3)
+	assert isinstance(scaled, IndexedImage)
+	np.testing.assert_array_equal(scaled.indices, np.kron(indices, np.ones((3, 3), dtype=np.uint8)))
+	np.testing.assert_array_equal(scale_nearest(palette[indices], 3), palette[scaled.indices])
+
+def test_composite_over():
+	src = np.array([[255, 0, 0, 255], [255, 0, 0, 0], [255, 0, 0, 128]], dtype=np.uint8)
+	dst = np.array([0, 0, 255, 255], dtype=np.uint8)
+	out = composite_over(src, dst)
+	np.testing.assert_array_equal(out[0], [255, 0, 0, 255])
+	np.testing.assert_array_equal(out[1], [0, 0, 255, 255])
+	np.testing.assert_array_equal(out[2], [128, 0, 127, 255])
+	# nothing over nothing stays transparent instead of dividing by zero
+	np.testing.assert_array_equal(composite_over(np.zeros(4, dtype=np.uint8), np.zeros(4, dtype=np.uint8)), 0)
+
+def test_correspondence_clipped_to_both_layers():
+	c = LayerCorrespondence(0, 'front', (5, 10), (0, 32), (32, 9))
+	compiled = c.compile(Size(32, 32), Size(32, 41))
+	# 27 columns are left of the internal layer, and 9 rows of the external one
+	assert compiled.internal_slices == (slice(10, 19), slice(5, 32))
+	assert compiled.external_slices == (slice(32, 41), slice(0, 27))
+	assert c.compile(Size(32, 32), Size(32, 32)) is None
+
+def test_net_image_samples_pixel_centers():
+	plan = NetImagePlan([NetImagePlacement('0', (0, 0), (3, 5))])
+	table = plan.compile(((2, 2),))
+	# a 2×2 layer is 4 pixels after the transparent one at index 0
+	np.testing.assert_array_equal(table[:5, :3], 1 + np.array([
+		[0, 1, 1],
+		[0, 1, 1],
+		[2, 3, 3],
+		[2, 3, 3],
+		[2, 3, 3],
+	]))
+	assert (table[5:] == 0).all() and (table[:, 3:] == 0).all()
+	assert table.shape == NET_IMAGE_SIZE[::-1]
+
+def test_net_image_integer_scale_repeats_pixels():
+	plan = NetImagePlan([NetImagePlacement('0', (0, 0), (64, 96))])
+	layer = np.arange(32 * 32).reshape(32, 32)
+	table = plan.compile(((32, 32),))
+	np.testing.assert_array_equal(table[:96, :64] - 1, layer.repeat(3, axis=0).repeat(2, axis=1))
+
+@pytest.mark.parametrize('background', [None, (0xf3, 0xf5, 0xe7, 0xff)])
+@pytest.mark.parametrize('masked', [False, True])
+def test_draw_indexed_matches_draw(background, masked):
+	rng = np.random.default_rng(PALETTE_SIZE)
+	mask = None
+	if masked:
+		mask = np.zeros((*NET_IMAGE_SIZE[::-1], BYTES_PER_PIXEL), dtype=np.uint8)
+		mask[100:140] = (0, 0, 0, 200)
+
+	plan = NetImagePlan([
+		NetImagePlacement('front', (5, 5), (100, 150)),
+		NetImagePlacement('back', (120, 5), (113, 145)),
+	], background=background, mask=mask)
+	palette = random_palette(rng)
+	layers = {
+		'front': rng.integers(0, TRANSPARENT_INDEX + 1, (41, 32), dtype=np.uint8),
+		'back': rng.integers(0, TRANSPARENT_INDEX + 1, (41, 32), dtype=np.uint8),
+	}
+
+	indexed = plan.draw_indexed(palette, layers)
+	assert isinstance(indexed, IndexedImage) != masked
+	np.testing.assert_array_equal(
+		as_rgba(indexed),
+		plan.draw({name: palette[indices] for name, indices in layers.items()}),
+	)
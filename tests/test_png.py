@@ -0,0 +1,74 @@
+# © 2020 io mintz <io@mintz.cc>
+
+import io
+import struct
+
+import numpy as np
+import pytest
+
+from acnh import png
+
+# only used as a reference decoder
+Image = pytest.importorskip('PIL.Image')
+
+WIDTHS = [1, 3, 5, 7, 32, 33]
+
+def decode(data: bytes) -> np.ndarray:
+	with Image.open(io.BytesIO(data)) as im:
+		return np.asarray(im.convert('RGBA'))
+
+def chunks(data: bytes) -> dict:
+	assert data.startswith(png.SIGNATURE)
+	out = {}
+	pos = len(png.SIGNATURE)
+	while pos < len(data):
+		length, type = struct.unpack('>I4s', data[pos:pos + 8])
+		out[type] = data[pos + 8:pos + 8 + length]
+		pos += 12 + length
+	return out
+
+def random_palette(rng, num_colors, *, translucent):
+	palette = rng.integers(0, 256, (num_colors, 4), dtype=np.uint8)
+	palette[:, 3] = 0xFF
+	if translucent:
+		# one fully transparent entry at the end, like designs have, and a translucent one in the middle
+		palette[-1] = 0
+		palette[num_colors // 2, 3] = 0x80
+	return palette
+
+@pytest.mark.parametrize('width', WIDTHS)
+@pytest.mark.parametrize('num_colors, depth', [(2, 1), (3, 2), (4, 2), (16, 4), (17, 8), (256, 8)])
+@pytest.mark.parametrize('translucent', [False, True], ids=['opaque', 'translucent'])
+def test_encode_indexed(num_colors, depth, width, translucent):
+	rng = np.random.default_rng(num_colors * width)
+	palette = random_palette(rng, num_colors, translucent=translucent)
+	indices = rng.integers(0, num_colors, (9, width), dtype=np.uint8)
+	# make sure the highest index is used, since it sets all the bits of a pixel
+	indices[0, -1] = num_colors - 1
+
+	data = png.encode_indexed(palette, indices)
+	np.testing.assert_array_equal(decode(data), palette[indices])
+
+	parsed = chunks(data)
+	assert struct.unpack('>IIBB', parsed[b'IHDR'][:10]) == (width, 9, depth, png.COLOR_TYPE_PALETTE)
+	if translucent:
+		# the translucent entries are moved to the front so that tRNS only lists them
+		assert sorted(parsed[b'tRNS']) == sorted(palette[palette[:, 3] != 0xFF, 3])
+	else:
+		assert b'tRNS' not in parsed
+
+@pytest.mark.parametrize('width', WIDTHS)
+@pytest.mark.parametrize('num_colors', [1, 2, 16, 256, 257])
+def test_encode_rgba(num_colors, width):
+	rng = np.random.default_rng(num_colors + width)
+	colors = np.unique(rng.integers(0, 256, (num_colors, 4), dtype=np.uint8), axis=0)
+	assert len(colors) == num_colors
+	# use every color at least once
+	height = -(-num_colors // width)
+	pixels = rng.permutation(np.resize(colors, (height * width, 4))).reshape(height, width, 4)
+
+	data = png.encode_rgba(pixels)
+	np.testing.assert_array_equal(decode(data), pixels)
+
+	color_type = chunks(data)[b'IHDR'][9]
+	assert color_type == (png.COLOR_TYPE_PALETTE if num_colors <= png.MAX_PALETTE_SIZE else png.COLOR_TYPE_RGBA)
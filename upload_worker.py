@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# © 2020 io mintz <io@mintz.cc>
+
+"""Uploads queued images to Nintendo, and deletes designs queued for deletion when there's nothing to upload.
+Run one or more of these alongside the web app.
+"""
+
+import time
+import traceback
+
+from app import app
+from acnh.common import token_refresher
+from acnh.designs import db as designs_db
+
+# seconds to wait before checking for new jobs when the queue is empty
+POLL_INTERVAL = 1
+
+def main():
+	token_refresher.ensure_started(app)
+	while True:
+		with app.app_context():
+			image_id = designs_db.claim_upload()
+			if image_id is not None:
+				print('Uploading image', image_id)
+				try:
+					designs_db.process_upload(image_id)
+				except Exception:  # pylint: disable=broad-except
+					traceback.print_exc()
+				continue
+
+			if designs_db.reap_design_deletions():
+				continue
+
+		time.sleep(POLL_INTERVAL)
+
+if __name__ == '__main__':
+	main()
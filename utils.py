@@ -2,18 +2,23 @@
 
 import asyncio
 import base64
+import collections
 import contextlib
 import datetime as dt
+import hashlib
 import json
+import queue
 import secrets
 import subprocess
 import os
 import sys
+import threading
+import time
 import urllib.parse
 
 import flask.json
 import jinja2
-import wand.image
+import numpy as np
 import toml
 import asyncpg
 import syncpg
@@ -21,7 +26,8 @@ from flask import current_app, g, request, session, url_for
 from flask_wtf.csrf import CSRFProtect
 from flask_limiter import Limiter
 
-from acnh.errors import ACNHError, MissingUserAgentStringError, IncorrectAuthorizationError
+import xbrz_worker
+from acnh.errors import ACNHError, MissingUserAgentStringError, IncorrectAuthorizationError, DatabaseBusyError
 
 # config comes first to resolve circular imports
 with open('config.toml') as f:
@@ -38,8 +44,10 @@ def limiter_key():
 	with contextlib.suppress(KeyError):
 		return session['user_id']
 
-	with contextlib.suppress(AttributeError):
-		return request.user_id
+	# token exempt views leave this as None, and those requests must not all share one limit
+	user_id = getattr(request, 'user_id', None)
+	if user_id is not None:
+		return user_id
 
 	return get_ipaddr()
 
@@ -63,14 +71,142 @@ def init_app(app):
 	limiter.init_app(app)
 	token_exempt(app.send_static_file)
 
+class PGPool:
+	"""A thread safe pool of Postgres connections.
+
+	Each connection keeps the event loop it was made with, which is installed in whatever thread checks it out.
+	Connections idle for longer than health_check_interval seconds are pinged before being handed out,
+	and connections idle for longer than idle_timeout seconds are closed, down to min_size idle connections.
+	At most max_size connections are checked out at once; after that, callers wait up to acquire_timeout seconds.
+	"""
+	class _Entry:
+		__slots__ = ('conn', 'loop', 'last_used')
+
+		def __init__(self, conn, loop):
+			self.conn = conn
+			self.loop = loop
+			self.last_used = time.monotonic()
+
+	# pylint: disable=too-many-arguments
+	def __init__(
+		self, connect_kwargs, *,
+		min_size=1, max_size=10, idle_timeout=5 * 60, health_check_interval=30, acquire_timeout=30,
+	):
+		self.connect_kwargs = connect_kwargs
+		self.min_size = min_size
+		self.max_size = max_size
+		self.idle_timeout = idle_timeout
+		self.health_check_interval = health_check_interval
+		self.acquire_timeout = acquire_timeout
+		self._lock = threading.Lock()
+		self._reset()
+
+	@classmethod
+	def from_config(cls, connect_kwargs, config):
+		kwargs = {key.replace('-', '_'): value for key, value in config.items()}
+		return cls(connect_kwargs, **kwargs)
+
+	def _reset(self):
+		self._pid = os.getpid()
+		self._idle = collections.deque()
+		self._slots = threading.BoundedSemaphore(self.max_size)
+
+	def acquire(self) -> _Entry:
+		with self._lock:
+			# connections must not be shared with a forked child
+			if self._pid != os.getpid():
+				self._reset()
+			slots = self._slots
+
+		if not slots.acquire(timeout=self.acquire_timeout):
+			raise DatabaseBusyError
+		try:
+			return self._pop_healthy() or self._connect()
+		except BaseException:
+			slots.release()
+			raise
+
+	def release(self, entry):
+		entry.last_used = time.monotonic()
+		with self._lock:
+			self._idle.append(entry)
+		self._slots.release()
+		self._prune()
+
+	def discard(self, entry):
+		"""Close a checked out connection instead of releasing it, e.g. because it might be broken."""
+		self._close(entry)
+		self._slots.release()
+
+	def _connect(self):
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		return self._Entry(syncpg.connect(**self.connect_kwargs), loop)
+
+	def _pop_healthy(self):
+		while True:
+			with self._lock:
+				if not self._idle:
+					return None
+				# LIFO, so that rarely needed connections go idle and get pruned
+				entry = self._idle.pop()
+
+			asyncio.set_event_loop(entry.loop)
+			if time.monotonic() - entry.last_used < self.health_check_interval:
+				return entry
+
+			try:
+				entry.conn.fetchval('SELECT 1')
+			except Exception:  # pylint: disable=broad-except
+				self._close(entry)
+			else:
+				return entry
+
+	def _prune(self):
+		now = time.monotonic()
+		expired = []
+		with self._lock:
+			while len(self._idle) > self.min_size and now - self._idle[0].last_used > self.idle_timeout:
+				expired.append(self._idle.popleft())
+
+		for entry in expired:
+			self._close(entry)
+
+	@staticmethod
+	def _close(entry):
+		asyncio.set_event_loop(entry.loop)
+		with contextlib.suppress(Exception):
+			entry.conn.close()
+		entry.loop.close()
+
+pg_pool = PGPool.from_config(config['postgres-db'], config.get('postgres-pool', {}))
+
 def pg():
 	with contextlib.suppress(AttributeError):
 		return g.pg
 
-	asyncio.set_event_loop(asyncio.new_event_loop())
-	pg = syncpg.connect(**config['postgres-db'])
-	g.pg = pg
-	return pg
+	g.pg_entry = entry = pg_pool.acquire()
+	g.pg = entry.conn
+	return entry.conn
+
+def release_pg():
+	"""Return this app context's connection to the pool early, e.g. before streaming a long response."""
+	with contextlib.suppress(AttributeError):
+		entry = g.pg_entry
+		del g.pg_entry, g.pg
+		pg_pool.release(entry)
+
+@contextlib.contextmanager
+def pg_connection():
+	"""Check out a connection for only the duration of the with block, rather than the rest of the app context."""
+	entry = pg_pool.acquire()
+	try:
+		yield entry.conn
+	except BaseException:
+		pg_pool.discard(entry)
+		raise
+	else:
+		pg_pool.release(entry)
 
 token_exempt_views = set()
 
@@ -114,15 +250,50 @@ def validate_token(token):
 	except ValueError:
 		return False
 
-	db_secret = pg().fetchval(queries.secret(), user_id)
-	if db_secret is None:
+	digest = secret_digest(user_id)
+	if digest is None:
 		return False
 
-	if not secrets.compare_digest(secret, db_secret):
+	if not secrets.compare_digest(hashlib.sha256(secret).digest(), digest):
 		return False
 
 	return user_id
 
+AUTHORIZATION_CACHE_DURATION = 5 * 60
+# touched whenever the authorizations table changes, so that all processes drop their caches
+AUTHORIZATIONS_CHANGED_PATH = 'tokens/authorizations-changed'
+# user_id: (sha256 of the secret, time cached)
+_authorization_cache = {}
+
+def secret_digest(user_id):
+	"""Return the SHA-256 digest of user_id's secret, or None if they don't exist. Cached."""
+	now = time.time()
+	try:
+		changed_at = os.stat(AUTHORIZATIONS_CHANGED_PATH).st_mtime
+	except FileNotFoundError:
+		changed_at = 0
+
+	with contextlib.suppress(KeyError):
+		digest, cached_at = _authorization_cache[user_id]
+		if cached_at > changed_at and now - cached_at < AUTHORIZATION_CACHE_DURATION:
+			return digest
+
+	secret = pg().fetchval(queries.secret(), user_id)
+	if secret is None:
+		# don't cache these, otherwise anyone could fill up the cache by trying lots of user IDs
+		_authorization_cache.pop(user_id, None)
+		return None
+
+	digest = hashlib.sha256(secret).digest()
+	_authorization_cache[user_id] = digest, now
+	return digest
+
+def invalidate_authorizations():
+	"""Make every process forget its cached authorizations. Call this after changing the authorizations table."""
+	_authorization_cache.clear()
+	with open(AUTHORIZATIONS_CHANGED_PATH, 'a'):
+		os.utime(AUTHORIZATIONS_CHANGED_PATH)
+
 def encode_token(user_id, secret):
 	left = str(user_id)
 	right = base64.urlsafe_b64encode(secret).rstrip(b'=').decode('ascii')
@@ -134,9 +305,13 @@ def parse_token(token):
 	secret += b'=' * (-len(secret) % 4)
 	return int(id), base64.urlsafe_b64decode(secret)
 
-def close_pgconn(_):
+def close_pgconn(exc):
 	with contextlib.suppress(AttributeError):
-		g.pg.close()
+		if exc is None:
+			pg_pool.release(g.pg_entry)
+		else:
+			# the connection may be why it failed, so don't hand it out again
+			pg_pool.discard(g.pg_entry)
 
 queries = jinja2.Environment(
 	loader=jinja2.FileSystemLoader('.'),
@@ -157,25 +332,71 @@ class CustomJSONEncoder(flask.json.JSONEncoder):
 			return dict(o)
 		return super().default(o)
 
-def xbrz_scale_wand_in_subprocess(img: wand.image.Image, factor):
-	data = bytearray(img.export_pixels(channel_map='RGBA', storage='char'))
-
-	p = subprocess.Popen(
-		[sys.executable, '-m', 'xbrz', *map(str, (factor, *img.size))],
-		stdin=subprocess.PIPE,
-		stdout=subprocess.PIPE,
-		stderr=subprocess.PIPE,
-	)
-	stdout, stderr = p.communicate(data)
-	if stderr and p.returncode:
-		raise RuntimeError(stderr.decode('utf-8'))
-
-	scaled = wand.image.Image(width=img.width * factor, height=img.height * factor)
-	scaled.import_pixels(channel_map='RGBA', storage='char', data=stdout)
-	return scaled
-
-def image_to_base64_url(img: wand.image.Image):
-	return (b'data:image/png;base64,' + base64.b64encode(img.make_blob('png'))).decode()
+class XBRZPool:
+	"""A pool of long-lived xbrz_worker processes, so that scaling an image doesn't cost an interpreter startup.
+
+	At most size workers are spawned (lazily). Callers wait for an idle worker once they are all busy.
+	"""
+	def __init__(self, size):
+		self.size = size
+		self._lock = threading.Lock()
+		self._reset()
+
+	def _reset(self):
+		self._pid = os.getpid()
+		self._idle = queue.LifoQueue()
+		self._slots = threading.BoundedSemaphore(self.size)
+
+	def _acquire(self):
+		with self._lock:
+			# workers (and their pipes) must not be shared with a forked child
+			if self._pid != os.getpid():
+				self._reset()
+			slots, idle = self._slots, self._idle
+
+		slots.acquire()
+		try:
+			return idle.get_nowait()
+		except queue.Empty:
+			return self._spawn()
+
+	@staticmethod
+	def _spawn():
+		return subprocess.Popen(
+			[sys.executable, '-m', 'xbrz_worker'],
+			stdin=subprocess.PIPE,
+			stdout=subprocess.PIPE,
+		)
+
+	def scale(self, data, factor, width, height) -> bytes:
+		"""Scale width × height RGBA pixels by factor."""
+		out_size = width * factor * height * factor * 4
+		worker = self._acquire()
+		try:
+			worker.stdin.write(xbrz_worker.HEADER.pack(factor, width, height))
+			worker.stdin.write(data)
+			worker.stdin.flush()
+			scaled = worker.stdout.read(out_size)
+			if len(scaled) != out_size:
+				raise RuntimeError(f'xbrz worker exited with code {worker.poll()}')
+		except BaseException:
+			worker.kill()
+			worker.wait()
+			raise
+		else:
+			self._idle.put(worker)
+		finally:
+			self._slots.release()
+
+		return scaled
+
+xbrz_pool = XBRZPool(config.get('xbrz-workers', os.cpu_count() or 1))
+
+def xbrz_scale_rgba(pixels: np.ndarray, factor) -> np.ndarray:
+	"""Scale a (height, width, 4) RGBA array by factor."""
+	height, width, _ = pixels.shape
+	scaled = xbrz_pool.scale(np.ascontiguousarray(pixels).tobytes(), factor, width, height)
+	return np.frombuffer(scaled, dtype=np.uint8).reshape(height * factor, width * factor, 4)
 
 def handle_acnh_exception(ex):
 	"""Return JSON instead of HTML for ACNH errors"""
@@ -1,26 +1,32 @@
 import contextlib
 import datetime as dt
+import functools
 import io
 import json
 import traceback
 import urllib.parse
+from http import HTTPStatus
 
 import flask.json
 import wand.image
-from flask import Blueprint, jsonify, current_app, request, stream_with_context
+from flask import Blueprint, jsonify, current_app, request, session, stream_with_context
 from werkzeug.exceptions import HTTPException
 
+import acnh.common as common
 import acnh.dodo as dodo
 import acnh.designs.api as designs_api
 import acnh.designs.render as designs_render
 import acnh.designs.db as designs_db
 import utils
 import tarfile_stream
+from acnh import png
 from acnh.errors import (
-	ACNHError,
 	InvalidDesignCodeError,
 	MissingLayerError,
+	InvalidLayerNameError,
 	InvalidScaleFactorError,
+	InvalidScaleFilterError,
+	ScalingRequiresAuthorizationError,
 	CannotScaleThumbnailError,
 	InvalidImageError,
 	InvalidImageIdError,
@@ -30,9 +36,14 @@ from acnh.errors import (
 	TiledImageTooBigError,
 	InvalidPaginationError,
 	InvalidPaginationLimitError,
+	DesignTimeoutError,
+	UnknownDodoCodeError,
 )
+from acnh.cache import Cache
+from acnh.utils import SingleFlight
 from acnh.designs.db import PageSpecifier, PageDirection
 from acnh.designs.encode import BasicDesign, Design
+from acnh.designs.pixels import IndexedImage, Pixels, as_rgba, scale_nearest
 from utils import limiter
 
 def init_app(app):
@@ -40,11 +51,60 @@ def init_app(app):
 
 bp = Blueprint('api', __name__, url_prefix='/api/v0')
 
+# designs cannot be updated, so renders of them never go stale
+render_cache = Cache.from_config(utils.config.get('render-cache', {}))
+render_flights = SingleFlight(timeout=designs_api.DOWNLOAD_TIMEOUT, timeout_error=DesignTimeoutError)
+
+# neither designs nor images can be updated, so clients may keep renders of them forever
+IMMUTABLE_CACHE_CONTROL = 'max-age=31536000, immutable'
+# bump this whenever the rendered output changes, so that neither we nor clients use old copies
+RENDER_VERSION = 5
+
+def render_key(*parts):
+	"""Identify a render, for caching it on the server and on the client."""
+	return (RENDER_VERSION, *parts)
+
+def render_etag(key):
+	return '-'.join(map(str, key))
+
+def not_modified(etag, validate_exists, *, public=False):
+	"""Return a 304 response if the client already has the resource identified by etag, otherwise None.
+	Call this before fetching or rendering anything.
+	validate_exists is only called before responding with 304. It should raise if the resource doesn't exist,
+	since anyone can make up an ETag.
+	"""
+	# If-Modified-Since is not honored, since it doesn't say which resource the client has a copy of
+	if not request.if_none_match.contains_weak(etag):
+		return None
+
+	validate_exists()
+	return cacheable(current_app.response_class(status=HTTPStatus.NOT_MODIFIED), etag, public=public)
+
+def cacheable(resp, etag, last_modified=None, *, public=False):
+	"""Mark resp as never changing. Only pass public for resources that don't need a token,
+	otherwise shared caches could hand them out to anyone.
+	"""
+	resp.set_etag(etag)
+	resp.headers['Cache-Control'] = ('public, ' if public else 'private, ') + IMMUTABLE_CACHE_CONTROL
+	if last_modified is not None:
+		resp.last_modified = dt.datetime.fromtimestamp(last_modified, dt.timezone.utc)
+	return resp
+
 @bp.route('/host-session/<dodo_code>')
 @limiter.limit('1 per 4 seconds')
 def host_session(dodo_code):
 	return dodo.search_dodo_code(dodo_code)
 
+@bp.route('/host-sessions')
+@limiter.limit('1 per 4 seconds')
+def host_sessions():
+	dodo_codes = request.args.get('dodo_codes', '').split(',')
+	return {
+		dodo_code: UnknownDodoCodeError().to_dict() if info is None else info
+		for dodo_code, info
+		in dodo.search_dodo_codes(dodo_codes).items()
+	}
+
 @bp.route('/design/<design_code>')
 @limiter.limit('5 per second')
 def design(design_code):
@@ -56,19 +116,45 @@ def get_scale_factor():
 	InvalidScaleFactorError.validate(scale_factor)
 	return int(scale_factor)
 
-def maybe_scale(image):
+DEFAULT_SCALE_FILTER = 'xbrz'
+
+def get_scaling():
+	"""Return the requested scale factor and filter. Together they identify how a render was scaled."""
 	scale_factor = get_scale_factor()
+	scale_filter = request.args.get('filter', DEFAULT_SCALE_FILTER)
+	InvalidScaleFilterError.validate(scale_filter)
 	if scale_factor == 1:
-		return image
+		# there's nothing to filter, so don't render or cache it separately
+		scale_filter = DEFAULT_SCALE_FILTER
+	return scale_factor, scale_filter
+
+def maybe_scale(pixels: Pixels) -> Pixels:
+	scale_factor, scale_filter = get_scaling()
+	if scale_factor == 1:
+		return pixels
+
+	if scale_filter == 'nearest':
+		# crisp and cheap, and stays indexed
+		return scale_nearest(pixels, scale_factor)
+	return utils.xbrz_scale_rgba(as_rgba(pixels), scale_factor)
 
-	return utils.xbrz_scale_wand_in_subprocess(image, scale_factor)
+def encode_png(pixels: Pixels) -> bytes:
+	if isinstance(pixels, IndexedImage):
+		# no need to count the colors if we already have a palette
+		return png.encode_indexed(pixels.palette, pixels.indices)
+	return png.encode_rgba(pixels)
 
 @bp.route('/design/<design_code>.tar')
 @limiter.limit('2 per 10 seconds')
 def design_archive(design_code):
 	InvalidDesignCodeError.validate(design_code)
 	render_internal = 'internal_layers' in request.args
-	get_scale_factor()  # do the validation now since apparently it doesn't work in the generator
+	scaling = get_scaling()  # do the validation now since apparently it doesn't work in the generator
+	etag = render_etag(render_key('design', designs_api.design_id(design_code), 'tar', *scaling, int(render_internal)))
+	resp = not_modified(etag, functools.partial(validate_design_exists, design_code))
+	if resp is not None:
+		return resp
+
 	data = designs_api.download_design(design_code)
 	meta, body = data['mMeta'], data['mData']
 	# pylint: disable=unused-variable
@@ -80,48 +166,85 @@ def design_archive(design_code):
 		if type_code == BasicDesign.type_code or render_internal:
 			layers = designs_render.render_layers(body)
 		else:
-			layers = Design.from_data(data).layer_images.items()
+			layers = Design.from_data(data).layer_pixels().items()
 
 		yield from make_tar(design_name, data['updated_at'], layers)
 
 	encoded_filename = urllib.parse.quote(design_name + '.tar')
-	return current_app.response_class(
+	return cacheable(current_app.response_class(
 		stream_with_context(gen()),
 		mimetype='application/x-tar',
 		headers={'Content-Disposition': f"attachment; filename*=utf-8''{encoded_filename}"},
-	)
+	), etag, data['updated_at'])
 
 def make_tar(design_name, updated_at, layers):
 	tar = tarfile_stream.open(mode='w|')
 	yield from tar.header()
 
-	for name, image in layers:
+	for name, pixels in layers:
 		tarinfo = tarfile_stream.TarInfo(f'{design_name}/{name}.png')
 		tarinfo.mtime = updated_at
 
-		image = maybe_scale(image)
-		out = io.BytesIO()
-		with image.convert('png') as c:
-			c.save(file=out)
-		tarinfo.size = out.tell()
-		out.seek(0)
+		encoded = encode_png(maybe_scale(pixels))
+		tarinfo.size = len(encoded)
 
-		yield from tar.addfile(tarinfo, out)
+		yield from tar.addfile(tarinfo, io.BytesIO(encoded))
 
 	yield from tar.footer()
 
+def validate_design_exists(design_code):
+	# only downloads the headers, which are usually cached
+	designs_api.download_design(design_code, partial=True)
+
+def serve_png_render(key_prefix, layer, render, validate_exists, *, public=False):
+	"""Respond with a PNG render of layer, from the render cache if possible.
+	key_prefix identifies what is being rendered. render(layer) returns its name, last modified time and pixels.
+	validate_exists and public are as for not_modified.
+	"""
+	if layer == 'thumbnail' and request.args.get('scale', '1') != '1':
+		raise CannotScaleThumbnailError
+
+	cache_key = render_key(*key_prefix, layer, *get_scaling(), 'png')
+	etag = render_etag(cache_key)
+	resp = not_modified(etag, validate_exists, public=public)
+	if resp is not None:
+		return resp
+
+	rendered = render_cache.get(cache_key)
+	if rendered is None:
+		rendered = render_flights.do(cache_key, _render_png, layer, render, cache_key=cache_key)
+
+	out = rendered['image']
+	encoded_filename = urllib.parse.quote(f"{rendered['name']}-{layer}.png")
+	return cacheable(current_app.response_class(out, mimetype='image/png', headers={
+		'Content-Length': len(out),
+		'Content-Disposition': f"inline; filename*=utf-8''{encoded_filename}"
+	}), etag, rendered['last_modified'], public=public)
+
+def _render_png(layer, render, *, cache_key):
+	name, last_modified, pixels = render(layer)
+	rv = {'name': name, 'last_modified': last_modified, 'image': encode_png(maybe_scale(pixels))}
+	# cache it before any other callers stop waiting on us
+	render_cache.set(cache_key, rv)
+	return rv
+
 # no rate limit as we need to render the thumbnails for all of an author's designs quickly
 @bp.route('/design/<design_code>/<layer>.png')
 def design_layer(design_code, layer):
 	InvalidDesignCodeError.validate(design_code)
+	return serve_png_render(
+		('design', designs_api.design_id(design_code)),
+		layer,
+		functools.partial(render_design_layer, design_code),
+		functools.partial(validate_design_exists, design_code),
+	)
+
+def render_design_layer(design_code, layer):
 	data = designs_api.download_design(design_code)
 	meta, body = data['mMeta'], data['mData']
-	design_name = meta['mMtDNm']
 
 	if layer == 'thumbnail':
-		if request.args.get('scale', '1') != '1':
-			raise CannotScaleThumbnailError
-		rendered = Design.from_data(data).net_image()
+		rendered = Design.from_data(data).net_image_pixels()
 	else:
 		try:
 			int(layer)
@@ -130,14 +253,7 @@ def design_layer(design_code, layer):
 		else:
 			rendered = designs_render.render_layer(body, layer)
 
-	rendered = maybe_scale(rendered)
-	out = rendered.make_blob('png')
-
-	encoded_filename = urllib.parse.quote(f'{design_name}-{layer}.png')
-	return current_app.response_class(out, mimetype='image/png', headers={
-		'Content-Length': len(out),
-		'Content-Disposition': f"inline; filename*=utf-8''{encoded_filename}"
-	})
+	return meta['mMtDNm'], data['updated_at'], rendered
 
 @bp.route('/designs/<author_id>')
 @limiter.limit('5 per 1 seconds')
@@ -165,13 +281,20 @@ def list_designs(author_id):
 @bp.route('/images', methods=['POST'])
 @limiter.limit('1 per 15s')
 def create_image():
-	gen = format_created_design_results(create_image_gen())
-	# Note: this is currently the only method (other than the rendering methods) which does *not* return JSON.
-	# This is due to its iterative nature. I considered using JSON anyway, but very few libraries
-	# support iterative JSON decoding, and we don't need anything other than an array anyway.
+	# Note: this and the progress endpoint are currently the only methods (other than the rendering methods)
+	# which do *not* return JSON. This is for consistency with the progress endpoint,
+	# which is iterative. Very few libraries support iterative JSON decoding,
+	# and we don't need anything other than an array anyway.
+	return current_app.response_class(f'{create_image_from_request()}\n', mimetype='text/plain')
+
+@bp.route('/image/<image_id>/progress')
+def image_progress(image_id):
+	image_id = int(InvalidImageIdError.validate(image_id))
+	gen = format_created_design_results(designs_db.upload_progress(image_id), header=False)
 	return current_app.response_class(stream_with_context(gen), mimetype='text/plain')
 
-def create_image_gen():
+def create_image_from_request() -> int:
+	"""Queue the image in the request to be uploaded. Returns its image ID."""
 	try:
 		image_name = request.values['image_name']
 	except KeyError:
@@ -180,13 +303,9 @@ def create_image_gen():
 	author_name = request.values.get('author_name') or 'Anonymous'  # we are legion
 
 	design_type_name = request.values.get('design_type', 'basic-design')
-	try:
-		if design_type_name == 'basic-design':
-			yield from create_basic_image(image_name, author_name)
-		else:
-			yield from create_pro_image(image_name, author_name, design_type_name)
-	except ACNHError as ex:
-		yield ex.to_dict()
+	if design_type_name == 'basic-design':
+		return create_basic_image(image_name, author_name)
+	return create_pro_image(image_name, author_name, design_type_name)
 
 def create_pro_image(image_name, author_name, design_type_name):
 	try:
@@ -211,7 +330,7 @@ def create_pro_image(image_name, author_name, design_type_name):
 	with contextlib.ExitStack() as stack:
 		for img in layers.values():
 			stack.enter_context(img)
-		yield from designs_db.create_image(design)
+		return designs_db.create_image(design)
 
 def create_basic_image(image_name, author_name):
 	width = height = None
@@ -246,7 +365,6 @@ def create_basic_image(image_name, author_name):
 
 	if width is not None and not scale:
 		img.transform(resize=f'{width}x{height}')
-	# do this again now because custom exception handlers don't run for generators ¯\_(ツ)_/¯
 	TiledImageTooBigError.validate(img)
 
 	design = BasicDesign(
@@ -257,7 +375,7 @@ def create_basic_image(image_name, author_name):
 	)
 
 	with img:
-		yield from designs_db.create_image(design, scale=scale)
+		return designs_db.create_image(design, scale=scale)
 
 def format_created_design_results(gen, *, header=True):
 	def maybe_error(row):
@@ -330,35 +448,71 @@ def image(image_id):
 @limiter.limit('2 per 10 seconds')
 def image_archive(image_id):
 	image_id = int(InvalidImageIdError.validate(image_id))
-	image_info = designs_db.image(image_id)['image']
 	render_internal = 'internal_layers' in request.args
-	layers = {}
-	cls = Design(image_info['type_code'])
-	for layer, image_blob in zip(cls.external_layers, image_info['layers']):
-		if image_info['pro']:
-			layers[layer.name] = img = layer.as_wand()
-		else:
-			layers[layer.name] = img = wand.image.Image(width=image_info['width'], height=image_info['height'])
+	etag = render_etag(render_key('image', image_id, 'tar', *get_scaling(), int(render_internal)))
+	resp = not_modified(etag, functools.partial(designs_db.validate_image_exists, image_id))
+	if resp is not None:
+		return resp
 
-		img.import_pixels(channel_map='RGBA', data=image_blob)
-
-	# pylint: disable=not-callable
-	design = cls(layers=layers)
+	image_info = designs_db.image(image_id)['image']
+	design = designs_db.image_design(image_info)
 	if render_internal:
-		requested_layers = enumerate(design.internalize())
+		requested_layers = enumerate(design.internalize_arrays())
 	else:
-		requested_layers = layers.items()
+		requested_layers = design.layer_arrays().items()
 
 	gen = make_tar(image_info['image_name'], image_info['created_at'].timestamp(), requested_layers)
 	encoded_filename = urllib.parse.quote(image_info['image_name'] + '.tar')
-	return current_app.response_class(
+	return cacheable(current_app.response_class(
 		stream_with_context(gen),
 		mimetype='application/x-tar',
 		headers={
 			'Content-Disposition': f"attachment; filename*=utf-8''{encoded_filename}",
 		},
+	), etag, image_info['created_at'].timestamp())
+
+# the scalings that image pages link to, which is all that people without a token may render
+PUBLIC_IMAGE_SCALINGS = {(1, DEFAULT_SCALE_FILTER), (6, DEFAULT_SCALE_FILTER)}
+
+def is_authorized():
+	"""Whether the request has a valid token. Unlike request.user_id, this also works in token exempt views."""
+	if session.get('user_id'):
+		return True
+	token = request.headers.get('Authorization')
+	return bool(token and utils.validate_token(token))
+
+# token exempt since image pages are meant to be shared.
+# renders are cached, but xBRZ scaling an uncached one is expensive, so unlike design_layer this is rate limited.
+# an image page loads at most 5 of these at once.
+@bp.route('/image/<image_id>/<layer>.png')
+@utils.token_exempt
+@limiter.limit('10 per 5 seconds')
+def image_layer(image_id, layer):
+	image_id = int(InvalidImageIdError.validate(image_id))
+	if get_scaling() not in PUBLIC_IMAGE_SCALINGS and not is_authorized():
+		raise ScalingRequiresAuthorizationError
+	return serve_png_render(
+		('image', image_id),
+		layer,
+		functools.partial(render_image_layer, image_id),
+		functools.partial(designs_db.validate_image_exists, image_id),
+		public=True,
 	)
 
+def render_image_layer(image_id, layer):
+	image_info = designs_db.image(image_id)['image']
+	design = designs_db.image_design(image_info)
+
+	if layer == 'thumbnail':
+		rendered = design.net_image_array()
+	else:
+		try:
+			rendered = design.layer_arrays()[layer]
+		except KeyError:
+			raise InvalidLayerNameError(design)
+
+	return image_info['image_name'], image_info['created_at'].timestamp(), rendered
+
 @bp.route('/image/<image_id>/refresh', methods=['POST'])
 def refresh_image(image_id):
 	gen = stream_with_context(format_created_design_results(_refresh_image(image_id), header=False))
@@ -373,6 +527,11 @@ def delete_image(image_id):
 	designs_db.delete_image(image_id)
 	return jsonify('OK')
 
+@bp.route('/token-ages')
+def token_ages():
+	"""Lets operators check that the token refresher is keeping up."""
+	return common.token_ages()
+
 @bp.errorhandler(HTTPException)
 def handle_exception(ex):
 	"""Return JSON instead of HTML for HTTP errors."""
@@ -3,8 +3,6 @@
 import datetime as dt
 from http import HTTPStatus
 
-import msgpack
-import wand.image
 from flask import (
 	abort,
 	Blueprint,
@@ -21,7 +19,7 @@ from werkzeug.exceptions import HTTPException
 import utils
 from views import api
 from acnh import dodo
-from acnh.common import acnh
+from acnh.common import creator_accounts_by_id
 from acnh.errors import (
 	ACNHError,
 	InvalidAuthorIdError,
@@ -37,11 +35,9 @@ from utils import limiter
 
 def init_app(app):
 	app.register_blueprint(bp)
-	api_author_id = utils.config['acnh-design-creator-id']
 	# for comparisons
-	app.add_template_global(api_author_id, name='api_author_id')
-	# for display
-	app.add_template_global(designs_api.add_hyphens(str(api_author_id)), name='pretty_api_author_id')
+	app.add_template_global(frozenset(creator_accounts_by_id), name='api_author_ids')
+	app.add_template_global(designs_api.add_hyphens, name='add_hyphens')
 	app.add_template_global(
 		"This design had to be quantized to fit the game's 16 color limit.",
 		name='quantized_message',
@@ -134,6 +130,10 @@ def designs_form():
 bp.route('/design/<design_code>/<layer>.png')(api.design_layer)
 bp.route('/design/<design_code>.tar')(api.design_archive)
 bp.route('/image/<image_id>.tar')(api.image_archive)
+bp.route('/image/<image_id>/<layer>.png')(api.image_layer)
+
+def layer_display_name(name):
+	return name.capitalize().replace('-', ' ')
 
 @bp.route('/design/<design_code>')
 @limiter.limit('2 per 10 seconds')
@@ -146,14 +146,12 @@ def design(design_code):
 	meta = data['mMeta']
 	design_name = meta['mMtDNm']
 
-	design = designs_encode.Design.from_data(data)
-
-	def gen():
-		for name, image in design.layer_images.items():
-			yield (
-				name.capitalize().replace('-', ' '),
-				utils.image_to_base64_url(utils.xbrz_scale_wand_in_subprocess(image, 6)),
-			)
+	# the images themselves are loaded separately, so that browsers can cache them
+	cls = designs_encode.Design(meta['mMtUse'])
+	layers = [
+		(layer_display_name(layer.name), url_for('.design_layer', design_code=design_code, layer=layer.name, scale=6))
+		for layer in cls.external_layers
+	]
 
 	return utils.stream_template(
 		'design.html',
@@ -164,10 +162,10 @@ def design(design_code):
 		pretty_author_id=designs_api.add_hyphens(str(data['author_id'])),
 		design_code=design_code,
 		design_name=design_name,
-		design_type=type(design).display_name,
+		design_type=cls.display_name,
 		island_name=meta['mMtVNm'],
-		layers=stream_with_context(gen()),
-		preview=utils.image_to_base64_url(design.net_image()) if meta['mMtPro'] else None,
+		layers=layers,
+		preview=url_for('.design_layer', design_code=design_code, layer='thumbnail') if meta['mMtPro'] else None,
 	)
 
 @bp.route('/designs/<author_id>')
@@ -183,6 +181,7 @@ def pro_designs(author_id):
 def designs(author_id, *, pro):
 	author_id = int(InvalidAuthorIdError.validate(author_id).replace('-', ''))
 	pretty_author_id = designs_api.add_hyphens(str(author_id))
+	# with the body URLs, so that fetching the thumbnails doesn't have to look up each design again
 	data = designs_api.list_designs(author_id, pro=pro, with_binaries=True)
 	if not data['total']:
 		return render_template(
@@ -192,24 +191,21 @@ def designs(author_id, *, pro):
 
 	author_name = data['headers'][0]['design_player_name']
 
-	def designs():
-		for header in data['headers']:
-			design_data = msgpack.loads(acnh().request('GET', header['body']).content)
-			designs_api.merge_headers(design_data, header)
-			design_code = designs_api.design_code(header['id'])
-			net_image = designs_encode.Design.from_data(design_data).net_image()
-			yield (
-				design_data['mMeta']['mMtDNm'],
-				design_code,
-				utils.image_to_base64_url(net_image),
-			)
+	designs = []
+	for header in data['headers']:
+		design_code = designs_api.design_code(header['id'])
+		designs.append((
+			header['name'],
+			design_code,
+			url_for('.design_layer', design_code=design_code, layer='thumbnail'),
+		))
 
-	return utils.stream_template(
+	return render_template(
 		'designs.html',
 		author_id=pretty_author_id,
 		author_name=author_name,
 		pro=pro,
-		designs=stream_with_context(designs()),
+		designs=designs,
 		design_type='Pro' if pro else 'basic',
 	)
 
@@ -224,14 +220,17 @@ def create_basic_design_form():
 @bp.route('/create-design/<_>', methods=['POST'])
 @limiter.limit('1 per 15 seconds')
 def create_image(_):
-	gen = stream_with_context(api.create_image_gen())
-	image_id = next(gen)
-	return utils.stream_template(
-		'created_image.html', image_id=image_id, results=format_created_designs_gen(gen), verb='created',
-	)
+	image_id = api.create_image_from_request()
+	results = stream_with_context(format_created_designs_gen(designs_db.upload_progress(image_id)))
+	return utils.stream_template('created_image.html', image_id=image_id, results=results, verb='created')
 
 def format_created_designs_gen(gen):
-	for was_quantized, design_id in gen:
+	for row in gen:
+		if isinstance(row, dict):
+			# the upload failed. pass the error on to the template.
+			yield row
+			return
+		was_quantized, design_id = row
 		yield was_quantized, designs_api.design_code(design_id)
 
 @bp.route('/create-design/<design_type_name>')
@@ -251,44 +250,36 @@ def image(image_id):
 	image_info = data['image']
 	designs = data['designs']
 	cls = designs_encode.Design(image_info['type_code'])
-	cls_kwargs = dict(author_name=image_info['author_name'], design_name=image_info['image_name'])
 	if image_info['pro']:
-		layers = designs_db.gather_layers(cls, image_info['layers'])
-
-		# pylint: disable=not-callable
-		design = cls(layers=layers, **cls_kwargs)
-
-		layers = stream_with_context(
-			(
-				name.capitalize().replace('-', ' '),
-				utils.image_to_base64_url(utils.xbrz_scale_wand_in_subprocess(image, 6))
-			)
-			for name, image
-			in design.layer_images.items()
-		)
+		layers = [
+			(layer_display_name(layer.name), url_for('.image_layer', image_id=image_id, layer=layer.name, scale=6))
+			for layer in cls.external_layers
+		]
 	else:
-		img = wand.image.Image(width=image_info['width'], height=image_info['height'])
-		img.import_pixels(data=image_info['layers'][0], channel_map='RGBA')
-		if image_info['designs_required'] == 1:
-			img = utils.xbrz_scale_wand_in_subprocess(img, 6)
-		# pylint: disable=not-callable
-		design = cls(**cls_kwargs, layers={'0': img})
-		layers = stream_with_context([('0', utils.image_to_base64_url(img))])
+		# only scale it up if it's as small as a single design
+		scale = 6 if image_info['designs_required'] == 1 else 1
+		layers = [('0', url_for('.image_layer', image_id=image_id, layer='0', scale=scale))]
 
-	return utils.stream_template(
+	return render_template(
 		'image.html',
-		image=image_info, design=design, layers=layers, designs=designs,
+		image=image_info, layers=layers, designs=designs,
 		design_type=cls.display_name,
-		# make it an iterable so that it can be streamed
-		preview=utils.image_to_base64_url(design.net_image()) if image_info['pro'] else None
+		preview=url_for('.image_layer', image_id=image_id, layer='thumbnail') if image_info['pro'] else None,
 	)
 
 @bp.route('/refresh-image/<image_id>')
 @utils.token_exempt
-# no rate limit because this endpoint has no effect if it doesn't need to run
+# watching the upload holds a request open for up to a few minutes
+@limiter.limit('1 per 15 seconds')
 def refresh_image(image_id):
 	image_id = int(api.InvalidImageIdError.validate(image_id))
-	results = stream_with_context(format_created_designs_gen(designs_db.refresh_image(image_id)))
+	progress = designs_db.refresh_image(image_id, watch_existing=False)
+	if progress is None:
+		# whoever queued it is already watching it. don't hold another request open for everyone else who visits.
+		flash('This image is already being refreshed. Check back in a minute.', 'message')
+		return redirect(url_for('.image', image_id=image_id))
+
+	results = stream_with_context(format_created_designs_gen(progress))
 	return utils.stream_template('created_image.html', image_id=image_id, results=results, verb='refreshed')
 
 @bp.route('/image/<image_id>/delete', methods=['POST'])
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# © 2020 io mintz <io@mintz.cc>
+
+"""A long-lived xBRZ scaling process. See utils.XBRZPool.
+
+Each request on stdin is a HEADER followed by width × height RGBA pixels.
+The scaled pixels are written to stdout. EOF on stdin shuts the worker down.
+"""
+
+import struct
+import sys
+
+# factor, width, height
+HEADER = struct.Struct('<BHH')
+
+def main():
+	import xbrz  # only the worker needs this
+
+	stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+	while True:
+		header = stdin.read(HEADER.size)
+		if len(header) < HEADER.size:
+			return
+
+		factor, width, height = HEADER.unpack(header)
+		data = bytearray(stdin.read(width * height * 4))
+		stdout.write(xbrz.scale(data, factor, width, height, xbrz.ColorFormat.RGBA))
+		stdout.flush()
+
+if __name__ == '__main__':
+	main()